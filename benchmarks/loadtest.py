@@ -0,0 +1,453 @@
+import os
+import sys
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+from io import BytesIO
+from collections import defaultdict
+
+import aiohttp
+from aiohttp import web
+
+# Нагрузочный тест bot.py без Telegram и OpenRouter.
+#
+# Поднимает aiohttp-приложение бота вместе с worker, заглушку Bot API и
+# заглушку OpenRouter с настраиваемой задержкой (обе в отдельном потоке со
+# своим event loop, чтобы не мешать измерениям), Redis — fakeredis или
+# настоящий через --redis. Синтетические пользователи проходят полный путь
+# /start → модель → режим → формат → [фото] → промпт → картинка, апдейты
+# отправляются в /webhook с заданной частотой.
+#
+# Нужны зависимости для разработки (fakeredis, lupa для Lua-скриптов):
+#
+#   pip install -r requirements-dev.txt
+#   python benchmarks/loadtest.py --users 200 --rps 50 --photo-share 0.3
+#
+# Итог — JSON: перцентили end-to-end, время ответа webhook, пропускная
+# способность и лаг event loop процесса бота.
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TOKEN = "123456:LOADTEST"
+FLOW_STEPS = ["generate", "model_nano", None, "format_1_1"]
+
+
+# ================= ЗАГЛУШКИ =================
+
+def _make_image(size, image_format):
+    from PIL import Image
+
+    # шум, чтобы размер файла был похож на настоящую генерацию
+    image = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+    buffer = BytesIO()
+    image.save(buffer, format=image_format)
+
+    return buffer.getvalue()
+
+
+class FakeUpstreams:
+
+    # Bot API и OpenRouter в отдельном потоке. О каждом вызове Bot API
+    # сообщаем в loop бота: нагрузочный клиент ждёт ответов по chat_id.
+
+    def __init__(self, args, main_loop):
+        self.args = args
+        self.main_loop = main_loop
+        self.inboxes = defaultdict(asyncio.Queue)
+        self.openrouter_calls = 0
+        self.message_id = 0
+
+        self.image = _make_image(args.image_size, args.image_format.upper())
+        self.image_b64 = base64.b64encode(self.image).decode()
+        self.photo = _make_image(512, "JPEG")
+
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._serve, name="fake-upstreams", daemon=True)
+
+    # ---------- Bot API ----------
+
+    def _message(self, chat_id, message_id=None, **extra):
+        if message_id is None:
+            self.message_id += 1
+            message_id = self.message_id
+
+        return {
+            "message_id": int(message_id),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            **extra,
+        }
+
+    def _notify(self, chat_id, method, params):
+        self.main_loop.call_soon_threadsafe(self._deliver, int(chat_id), (method, params.get("text", "")))
+
+    def _deliver(self, chat_id, event):
+        # выполняется в loop бота, там же живут очереди
+        self.inboxes[chat_id].put_nowait(event)
+
+    async def bot_api(self, request):
+
+        method = request.match_info["method"]
+
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = {key: value for key, value in (await request.post()).items() if isinstance(value, str)}
+
+        chat_id = params.get("chat_id")
+
+        # chat_id для callback зашит в id запроса
+        if method == "answerCallbackQuery":
+            chat_id = params["callback_query_id"].split(":")[0]
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+
+        elif method == "getFile":
+            file_id = params["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_path": f"photos/{file_id}.jpg"}
+
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, params.get("message_id"), text=params.get("text", ""))
+
+        elif method == "sendPhoto":
+            file_id = f"photo-{self.message_id + 1}"
+            result = self._message(chat_id, photo=[{
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "width": self.args.image_size,
+                "height": self.args.image_size,
+            }])
+
+        elif method == "sendDocument":
+            result = self._message(chat_id)
+
+        else:
+            result = True
+
+        if chat_id is not None:
+            self._notify(chat_id, method, params)
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def bot_file(self, request):
+        return web.Response(body=self.photo, content_type="image/jpeg")
+
+    # ---------- OpenRouter ----------
+
+    async def openrouter(self, request):
+
+        await request.read()
+        self.openrouter_calls += 1
+
+        latency = max(0.0, random.gauss(self.args.upstream_latency, self.args.upstream_jitter))
+        await asyncio.sleep(latency)
+
+        if random.random() < self.args.upstream_error_rate:
+            return web.json_response({"error": {"code": 503, "message": "overloaded"}}, status=503)
+
+        return web.json_response({
+            "id": "gen-loadtest",
+            "choices": [{
+                "message": {
+                    "role": "assistant",
+                    "content": "",
+                    "images": [{
+                        "type": "image_url",
+                        "image_url": {"url": f"data:image/{self.args.image_format};base64,{self.image_b64}"}
+                    }]
+                }
+            }]
+        })
+
+    # ---------- Сервер ----------
+
+    def _serve(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/file/{token}/{path:.*}", self.bot_file)
+        app.router.add_post("/api/v1/chat/completions", self.openrouter)
+        app.router.add_route("*", "/{token}/{method}", self.bot_api)
+
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+
+        self.port = runner.addresses[0][1]
+        self._ready.set()
+
+        await self._stop.wait()
+        await runner.cleanup()
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+        return f"http://127.0.0.1:{self.port}"
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join()
+
+
+# ================= НАГРУЗКА =================
+
+def _percentiles(values):
+
+    if not values:
+        return None
+
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 1)
+
+    return {"p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": pick(1.0)}
+
+
+class LoadClient:
+
+    def __init__(self, session, webhook_url, upstreams, timeout):
+        self.session = session
+        self.webhook_url = webhook_url
+        self.upstreams = upstreams
+        self.timeout = timeout
+        self.update_id = 0
+
+        self.updates = 0
+        self.webhook_latency = []
+        self.e2e = []
+        self.prompt_to_result = []
+        self.outcomes = defaultdict(int)
+
+    async def post(self, update):
+        self.update_id += 1
+        update["update_id"] = self.update_id
+
+        started = time.perf_counter()
+
+        async with self.session.post(self.webhook_url, json=update) as resp:
+            await resp.read()
+
+        self.webhook_latency.append(time.perf_counter() - started)
+        self.updates += 1
+
+    async def expect(self, chat_id, predicate):
+        inbox = self.upstreams.inboxes[chat_id]
+
+        while True:
+            method, text = await asyncio.wait_for(inbox.get(), self.timeout)
+
+            if predicate(method, text):
+                return method, text
+
+    @staticmethod
+    def _user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def _message(self, user_id, **fields):
+        return {"message": {
+            "message_id": self.update_id + 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            **fields,
+        }}
+
+    def _callback(self, user_id, data):
+        return {"callback_query": {
+            "id": f"{user_id}:{self.update_id + 1}",
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "menu",
+            },
+        }}
+
+    async def flow(self, user_id, with_photo, set_balance):
+
+        started = time.perf_counter()
+
+        try:
+            await self.post(self._message(user_id, text="/start"))
+            await self.expect(user_id, lambda method, text: method == "sendMessage")
+
+            await set_balance(user_id, 1000)
+
+            for step in FLOW_STEPS:
+                data = step or ("mode_image" if with_photo else "mode_text")
+                await self.post(self._callback(user_id, data))
+                await self.expect(user_id, lambda method, text: method == "answerCallbackQuery")
+
+            if with_photo:
+                await self.post(self._message(user_id, photo=[{
+                    "file_id": f"in-{user_id}",
+                    "file_unique_id": f"in-{user_id}",
+                    "width": 512,
+                    "height": 512,
+                }]))
+                await self.expect(user_id, lambda method, text: method == "sendMessage")
+
+            prompt_sent = time.perf_counter()
+            await self.post(self._message(user_id, text=f"loadtest prompt {user_id}"))
+
+            method, text = await self.expect(
+                user_id,
+                lambda method, text: method == "sendPhoto" or (method == "sendMessage" and text.startswith(("❌", "⏳ Слишком")))
+            )
+
+        except asyncio.TimeoutError:
+            self.outcomes["timeout"] += 1
+            return
+
+        if method == "sendPhoto":
+            finished = time.perf_counter()
+            self.e2e.append(finished - started)
+            self.prompt_to_result.append(finished - prompt_sent)
+            self.outcomes["ok"] += 1
+        else:
+            self.outcomes["failed"] += 1
+
+
+async def _loop_lag(samples, stop, interval=0.05):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+# ================= ЗАПУСК =================
+
+def _configure_env(args, upstream_url, workdir):
+
+    os.environ["BOT_TOKEN"] = TOKEN
+    os.environ["RAILWAY_PUBLIC_DOMAIN"] = "loadtest.local"
+    os.environ["REDIS_PUBLIC_URL"] = args.redis or "redis://fakeredis"
+    os.environ["TELEGRAM_API_URL"] = upstream_url
+    os.environ["OPENROUTER_URL"] = f"{upstream_url}/api/v1/chat/completions"
+    os.environ["OPENROUTER_API_KEY"] = "loadtest"
+    os.environ["DATABASE_PATH"] = os.path.join(workdir, "loadtest.db")
+    os.environ["GENERATION_WORKERS"] = str(args.workers)
+
+    # лимиты частоты измеряли бы сами себя — по умолчанию снимаем глобальные
+    if not args.keep_rate_limits:
+        os.environ.setdefault("RATE_LIMIT_GENERATION_GLOBAL", "100000,100000")
+        os.environ.setdefault("RATE_LIMIT_DEFAULT_USER", "1000,1000")
+
+
+def _use_fakeredis():
+    import fakeredis
+    from redis.asyncio import Redis
+
+    server = fakeredis.FakeServer()
+
+    # bot.py создаёт клиента через Redis.from_url при импорте
+    Redis.from_url = classmethod(lambda cls, url, **kwargs: fakeredis.aioredis.FakeRedis(server=server))
+
+
+async def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100, help="сколько пользовательских сценариев")
+    parser.add_argument("--rps", type=float, default=20, help="целевая частота апдейтов в /webhook")
+    parser.add_argument("--photo-share", type=float, default=0.3, help="доля сценариев с фото")
+    parser.add_argument("--workers", type=int, default=3, help="сколько worker в процессе бота (потолок параллельности)")
+    parser.add_argument("--upstream-latency", type=float, default=2.0)
+    parser.add_argument("--upstream-jitter", type=float, default=0.5)
+    parser.add_argument("--upstream-error-rate", type=float, default=0.0)
+    parser.add_argument("--image-size", type=int, default=1024)
+    parser.add_argument("--image-format", choices=["png", "jpeg"], default="png")
+    parser.add_argument("--timeout", type=float, default=300, help="ожидание ответа бота на шаг, сек")
+    parser.add_argument("--redis", help="URL настоящего Redis вместо fakeredis")
+    parser.add_argument("--keep-rate-limits", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    upstreams = FakeUpstreams(args, asyncio.get_running_loop())
+    upstream_url = upstreams.start()
+
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    _configure_env(args, upstream_url, workdir)
+
+    if not args.redis:
+        _use_fakeredis()
+
+    import bot
+    import user_cache
+
+    runner = web.AppRunner(bot.app, access_log=None)
+    await runner.setup()
+
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+
+    port = runner.addresses[0][1]
+
+    lag = []
+    stop_lag = asyncio.Event()
+    lag_task = asyncio.create_task(_loop_lag(lag, stop_lag))
+
+    # частота апдейтов → частота старта сценариев (в сценарии 6–7 апдейтов)
+    updates_per_flow = 6 + args.photo_share
+    flow_interval = updates_per_flow / args.rps
+
+    async with aiohttp.ClientSession() as session:
+
+        client = LoadClient(session, f"http://127.0.0.1:{port}{bot.WEBHOOK_PATH}", upstreams, args.timeout)
+
+        started = time.perf_counter()
+        flows = []
+
+        for n in range(args.users):
+            user_id = 10_000_000 + n
+            flows.append(asyncio.create_task(
+                client.flow(user_id, random.random() < args.photo_share, user_cache.set_balance)
+            ))
+
+            await asyncio.sleep(flow_interval)
+
+        await asyncio.gather(*flows)
+        elapsed = time.perf_counter() - started
+
+    stop_lag.set()
+    await lag_task
+
+    await runner.cleanup()
+    upstreams.stop()
+
+    report = {
+        "users": args.users,
+        "target_rps": args.rps,
+        "duration_s": round(elapsed, 2),
+        "outcomes": dict(client.outcomes),
+        "updates_sent": client.updates,
+        "updates_per_sec": round(client.updates / elapsed, 1),
+        "generations_per_sec": round(client.outcomes["ok"] / elapsed, 2),
+        "openrouter_calls": upstreams.openrouter_calls,
+        "webhook_ack": _percentiles(client.webhook_latency),
+        "end_to_end": _percentiles(client.e2e),
+        "prompt_to_result": _percentiles(client.prompt_to_result),
+        "event_loop_lag": _percentiles(lag),
+    }
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
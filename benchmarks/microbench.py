@@ -0,0 +1,305 @@
+import os
+import sys
+import json
+import time
+import base64
+import random
+import asyncio
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+from io import BytesIO
+
+# Микробенчмарки горячих функций по отдельности: database.py на таблицах
+# разного размера и кодирование изображений (base64, PIL decode → JPEG).
+#
+#   python benchmarks/microbench.py --generations 10000,1000000,10000000 --output main.json
+#
+# Таблицы наполняются по возрастанию размера в одной БД, замеры идут после
+# каждого шага. Результат — JSON с перцентилями в микросекундах, его удобно
+# сравнивать между ветками.
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LOAD_BATCH = 100_000
+
+
+# ================= ИЗМЕРЕНИЕ =================
+
+def _summary(samples, total):
+    samples = sorted(samples)
+
+    def pick(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1e6, 1)
+
+    return {
+        "iterations": len(samples),
+        "ops_per_sec": round(len(samples) / total, 1),
+        "p50_us": pick(0.5),
+        "p95_us": pick(0.95),
+        "p99_us": pick(0.99),
+        "max_us": pick(1.0),
+    }
+
+
+async def _bench_async(func, iterations, warmup=20):
+
+    for i in range(warmup):
+        await func(i)
+
+    samples = []
+    started = time.perf_counter()
+
+    for i in range(iterations):
+        call_started = time.perf_counter()
+        await func(warmup + i)
+        samples.append(time.perf_counter() - call_started)
+
+    return _summary(samples, time.perf_counter() - started)
+
+
+def _bench_sync(func, iterations, warmup=2):
+
+    for _ in range(warmup):
+        func()
+
+    samples = []
+    started = time.perf_counter()
+
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - call_started)
+
+    return _summary(samples, time.perf_counter() - started)
+
+
+# ================= БАЗА =================
+
+def _load(path, generations, users, payments, state):
+
+    # наполнение идёт мимо database.py, но через те же триггеры счётчиков
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+
+    rng = random.Random(generations)
+
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id, balance) VALUES (?, ?)",
+            ((user_id, 1_000_000) for user_id in range(state["users"] + 1, users + 1))
+        )
+
+    while state["generations"] < generations:
+        count = min(LOAD_BATCH, generations - state["generations"])
+
+        with conn:
+            conn.executemany(
+                "INSERT INTO generations (user_id, model) VALUES (?, ?)",
+                ((rng.randint(1, users), "google/gemini-2.5-flash-image") for _ in range(count))
+            )
+
+        state["generations"] += count
+
+    with conn:
+        conn.executemany(
+            "INSERT INTO payments (payment_id, user_id, amount, status) VALUES (?, ?, ?, 'success')",
+            ((f"seed-{n}", rng.randint(1, users), 500) for n in range(state["payments"], payments))
+        )
+
+    state["users"] = max(state["users"], users)
+    state["payments"] = max(state["payments"], payments)
+
+    conn.close()
+
+
+async def _bench_database(database, users, iterations, run_id):
+
+    rng = random.Random(users)
+    results = {}
+
+    async def get_user(i):
+        await database.get_user(rng.randint(1, users))
+
+    async def deduct_and_add_generation(i):
+        # прежний путь worker: два отдельных commit
+        user_id = rng.randint(1, users)
+        await database.deduct_balance(user_id, 10)
+        await database.add_generation(user_id, "bench-model")
+
+    async def settle_generation(i):
+        # текущий путь: списание и запись генерации одной транзакцией
+        await database.settle_generation(rng.randint(1, users), "bench-model", 10)
+
+    async def credit_payment(i):
+        await database.credit_payment(f"bench-{run_id}-{users}-{i}", rng.randint(1, users), 500, 550)
+
+    async def credit_payment_duplicate(i):
+        # повторный webhook YooKassa по уже зачисленному платежу
+        await database.credit_payment(f"bench-{run_id}-{users}-0", 1, 500, 550)
+
+    async def get_user_generations_count(i):
+        await database.get_user_generations_count(rng.randint(1, users))
+
+    for name, func in [
+        ("get_user", get_user),
+        ("deduct_balance+add_generation", deduct_and_add_generation),
+        ("settle_generation", settle_generation),
+        ("credit_payment", credit_payment),
+        ("credit_payment_duplicate", credit_payment_duplicate),
+        ("get_user_generations_count", get_user_generations_count),
+    ]:
+        results[name] = await _bench_async(func, iterations)
+
+    return results
+
+
+# ================= ИЗОБРАЖЕНИЯ =================
+
+def _make_photo(side, image_format, quality=90):
+    from PIL import Image
+
+    # градиенты с шумом: размер файла ближе к фотографии, чем у шума или заливки
+    gradient = Image.linear_gradient("L").resize((side, side))
+    noise = Image.effect_noise((side, side), 48)
+    image = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.ROTATE_90)))
+
+    buffer = BytesIO()
+
+    if image_format == "JPEG":
+        image.save(buffer, format="JPEG", quality=quality)
+    else:
+        image.save(buffer, format=image_format)
+
+    return buffer.getvalue()
+
+
+def _bench_codec(sides, iterations):
+
+    from image_pipeline import _reencode, RESULT_MAX_SIDE, RESULT_JPEG_QUALITY
+
+    results = []
+
+    for side in sides:
+        jpeg = _make_photo(side, "JPEG")
+        png = _make_photo(side, "PNG")
+        encoded = base64.b64encode(jpeg)
+
+        results.append({
+            "side": side,
+            "jpeg_bytes": len(jpeg),
+            "png_bytes": len(png),
+            "benchmarks": {
+                "b64encode_jpeg": _bench_sync(lambda: base64.b64encode(jpeg), iterations * 10),
+                "b64decode_jpeg": _bench_sync(lambda: base64.b64decode(encoded), iterations * 10),
+                "reencode_png_to_jpeg": _bench_sync(
+                    lambda: _reencode(png, RESULT_MAX_SIDE, RESULT_JPEG_QUALITY), iterations
+                ),
+                "reencode_jpeg_to_jpeg": _bench_sync(
+                    lambda: _reencode(jpeg, RESULT_MAX_SIDE, RESULT_JPEG_QUALITY), iterations
+                ),
+            },
+        })
+
+    return results
+
+
+# ================= ЗАПУСК =================
+
+def _meta(args):
+    import PIL
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        "label": args.label,
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "iterations": args.iterations,
+        "codec_iterations": args.codec_iterations,
+        "generations_per_user": args.generations_per_user,
+    }
+
+
+def _sizes(value):
+    return sorted(int(item) for item in value.split(","))
+
+
+async def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--generations", type=_sizes, default=_sizes("10000,100000"),
+                        help="размеры таблицы generations через запятую, например 10000,1000000,10000000")
+    parser.add_argument("--generations-per-user", type=int, default=20)
+    parser.add_argument("--payments-per-user", type=float, default=0.2)
+    parser.add_argument("--iterations", type=int, default=2000, help="вызовов на функцию БД")
+    parser.add_argument("--photo-sides", type=_sizes, default=_sizes("512,1024,2048"))
+    parser.add_argument("--codec-iterations", type=int, default=10, help="повторов пережатия на размер")
+    parser.add_argument("--skip-db", action="store_true")
+    parser.add_argument("--skip-codec", action="store_true")
+    parser.add_argument("--label", help="имя ветки / сборки в отчёте")
+    parser.add_argument("--output", help="файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    report = {"meta": _meta(args), "database": [], "codec": []}
+
+    workdir = tempfile.mkdtemp(prefix="microbench-")
+    os.environ["DATABASE_PATH"] = os.path.join(workdir, "bench.db")
+
+    # замеряем синхронные commit, а не отложенную запись
+    os.environ["WRITE_BEHIND"] = "0"
+
+    import database
+
+    if not args.skip_db:
+        state = {"users": 0, "generations": 0, "payments": 0}
+        run_id = os.getpid()
+
+        for generations in args.generations:
+            users = max(1, generations // args.generations_per_user)
+            payments = int(users * args.payments_per_user)
+
+            started = time.perf_counter()
+            _load(database.DB_PATH, generations, users, payments, state)
+            load_seconds = time.perf_counter() - started
+
+            print(f"loaded {generations} generations in {load_seconds:.1f}s", file=sys.stderr)
+
+            report["database"].append({
+                "generations": generations,
+                "users": users,
+                "payments": payments,
+                "load_seconds": round(load_seconds, 2),
+                "benchmarks": await _bench_database(database, users, args.iterations, run_id),
+            })
+
+    if not args.skip_codec:
+        report["codec"] = _bench_codec(args.photo_sides, args.codec_iterations)
+
+    await database.close_db()
+
+    output = json.dumps(report, indent=2)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+
+# Сравнение скорости вставок в generations: commit на каждую строку
+# против групповой записи через WriteBehindBuffer.
+#
+#   python benchmarks/write_behind.py --rows 20000 --concurrency 50
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+async def _run(database, rows, concurrency):
+
+    per_task = rows // concurrency
+
+    async def producer(offset):
+        for i in range(per_task):
+            await database.add_generation(offset + i, "bench-model")
+
+    started = time.perf_counter()
+
+    await asyncio.gather(*[producer(n * per_task) for n in range(concurrency)])
+
+    if database.write_behind is not None:
+        await database.write_behind.close()
+
+    elapsed = time.perf_counter() - started
+
+    return per_task * concurrency / elapsed
+
+
+async def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--batch", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.05)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-db-")
+    os.environ["DATABASE_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ["WRITE_BEHIND"] = "0"
+
+    import database
+
+    results = {"rows": args.rows, "concurrency": args.concurrency}
+
+    database.write_behind = None
+    results["per_row_commit_inserts_per_sec"] = round(await _run(database, args.rows, args.concurrency))
+
+    database.write_behind = database.WriteBehindBuffer(args.batch, args.interval)
+    results["write_behind_inserts_per_sec"] = round(await _run(database, args.rows, args.concurrency))
+
+    results["speedup"] = round(
+        results["write_behind_inserts_per_sec"] / results["per_row_commit_inserts_per_sec"], 2
+    )
+
+    await database.close_db()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
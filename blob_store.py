@@ -0,0 +1,32 @@
+import os
+import hashlib
+
+# Хранилище пользовательских изображений: сырые байты в Redis,
+# ключ — sha256 содержимого. В FSM и задачах хранится только ссылка.
+
+BLOB_PREFIX = "blob:"
+
+# данные храним не дольше 24 часов (см. политику конфиденциальности)
+BLOB_TTL = int(os.getenv("BLOB_TTL", 86400))
+
+
+def blob_ref(data: bytes):
+    return hashlib.sha256(data).hexdigest()
+
+
+async def put_blob(redis, data: bytes):
+
+    ref = blob_ref(data)
+    key = BLOB_PREFIX + ref
+
+    # такое изображение уже есть — только продлеваем срок хранения
+    if await redis.expire(key, BLOB_TTL):
+        return ref
+
+    await redis.set(key, data, ex=BLOB_TTL)
+
+    return ref
+
+
+async def get_blob(redis, ref: str):
+    return await redis.get(BLOB_PREFIX + ref)
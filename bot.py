@@ -1,4 +1,3 @@
-from database import conn, cursor
 import time
 import asyncio
 import hmac
@@ -6,21 +5,20 @@ import hashlib
 import os
 import json
 import logging
-import base64
 from aiohttp import web
-from PIL import Image
-from io import BytesIO
 
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import (
     Message,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     CallbackQuery,
+    WebAppInfo,
     BufferedInputFile,
-    WebAppInfo
 )
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
@@ -28,66 +26,101 @@ from aiogram.fsm.storage.redis import RedisStorage
 from redis.asyncio import Redis
 
 from database import (
+    get_users_count,
+    get_generations_count,
+    get_payments_stats,
+    get_user_generations_count,
+    get_user_paid_total,
+    log_event,
+    close_db,
+)
+from user_cache import (
     add_user,
     get_user,
     update_model,
     update_format,
-    deduct_balance,
     update_balance,
-    get_users_count,
-    get_generations_count,
-    get_payments_stats,
-    get_all_user_ids,
-    add_generation,
+    reserve_balance,
+    release_balance,
+    credit_payment,
+    configure as configure_user_cache,
+    listen_invalidations,
+    cache_stats,
+    collect_metrics as collect_cache_metrics,
 )
 
-from generator import generate_image_openrouter
-from payment import create_payment
+from generator import init_session, close_session
+from payment import (
+    create_payment,
+    forget_pending,
+    init_session as init_payment_session,
+    close_session as close_payment_session,
+)
+from task_queue import init_queue
+from scheduler import submit, dispatch, choose_lane, queue_depth
+from queue_status import register, status_updater
+from photo_loader import photo_meta
+from config import (
+    TOKEN,
+    PUBLIC_DOMAIN,
+    REDIS_URL,
+    TELEGRAM_API_URL,
+    ADMIN_ID,
+    GENERATION_PRICE,
+    GENERATION_WORKERS,
+    BALANCE_RESERVE,
+)
+from keyboards import main_menu, model_menu, mode_menu, format_menu
+from worker import start_workers, stop_workers, deliver_cached
+from result_cache import cache_enabled, cache_key, image_key
+from broadcast import start_broadcast, resume_broadcasts
+from rate_limit import ThrottlingMiddleware
+from notifications import notify, notification_worker
+from concurrency import limits, collect_metrics as collect_limit_metrics
+from timing import TimingMiddleware, MetricsMiddleware, RequestTimingMiddleware
+from profiler import profile as run_profiler, ProfilerBusy
+from metrics import (
+    QUEUE_DEPTH,
+    PAYMENT_WEBHOOKS,
+    metrics_handler,
+    start_metrics_server,
+    METRICS_PORT,
+    register_collector,
+)
 
 
 # ================= НАСТРОЙКИ =================
 
-TOKEN = os.getenv("BOT_TOKEN")
-PUBLIC_DOMAIN = os.getenv("RAILWAY_PUBLIC_DOMAIN")
-CHANNEL_USERNAME = "YourDesignerSpb"
-ADMIN_ID = 373830941
-
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_URL = f"https://{PUBLIC_DOMAIN}{WEBHOOK_PATH}"
 
 logging.basicConfig(level=logging.WARNING)
 
-bot = Bot(token=TOKEN)
-redis = Redis.from_url(os.getenv("REDIS_PUBLIC_URL"))
+bot = Bot(
+    token=TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
+redis = Redis.from_url(REDIS_URL)
 
 storage = RedisStorage(redis)
 
 dp = Dispatcher(storage=storage)
 
-ERROR_LOG = []
-GENERATION_PRICE = 10
-
-GENERATION_QUEUE_KEY = "generation_queue"
-
-# ================= GENERATION QUEUE =================
-
-GENERATION_DELAY = 15
-user_generation_times = {}
+# время запросов к Bot API идёт в разбивку времени апдейта
+bot.session.middleware(RequestTimingMiddleware())
 
+# полное время апдейта с разбивкой db / net / other, медленные пишутся в лог
+dp.update.outer_middleware(TimingMiddleware())
 
-async def check_generation_queue(user_id):
+# время обработки по хендлерам, включая отклонённые лимитом обновления
+dp.message.middleware(MetricsMiddleware())
+dp.callback_query.middleware(MetricsMiddleware())
 
-    now = time.time()
-
-    last_time = user_generation_times.get(user_id, 0)
-
-    if now - last_time < GENERATION_DELAY:
-        wait = int(GENERATION_DELAY - (now - last_time))
-        return False, wait
-
-    user_generation_times[user_id] = now
-    return True, 0
+# лимиты проверяются до хендлеров и обращений к БД
+dp.message.middleware(ThrottlingMiddleware(redis))
+dp.callback_query.middleware(ThrottlingMiddleware(redis))
 
+ERROR_LOG = []
 
 BONUS_TABLE = {
     100: 0,
@@ -104,56 +137,6 @@ class Generate(StatesGroup):
     waiting_prompt = State()
 
 
-# ================= UI =================
-
-def main_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎨 Сгенерировать изображение", callback_data="generate")],
-        [InlineKeyboardButton(text="👤 Личный кабинет", callback_data="profile")],
-        [InlineKeyboardButton(text="💰 Пополнить баланс", callback_data="topup")],
-        [InlineKeyboardButton(text="📢 TG канал", url=f"https://t.me/{CHANNEL_USERNAME}")],
-        [InlineKeyboardButton(text="ℹ️ О сервисе", callback_data="about")]
-    ])
-
-
-def model_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"Nano Banana — {GENERATION_PRICE}₽", callback_data="model_nano")],
-        [InlineKeyboardButton(text=f"Nano Banana Pro — {GENERATION_PRICE}₽", callback_data="model_pro")],
-        [InlineKeyboardButton(text=f"SeeDream — {GENERATION_PRICE}₽", callback_data="model_seedream")],
-        [InlineKeyboardButton(text="⬅ Назад", callback_data="back_main")]
-    ])
-
-
-def mode_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📝 Только текст", callback_data="mode_text")],
-        [InlineKeyboardButton(text="🖼 Фото + текст", callback_data="mode_image")],
-        [InlineKeyboardButton(text="⬅ Назад", callback_data="generate")]
-    ])
-
-
-def format_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="1:1", callback_data="format_1_1"),
-            InlineKeyboardButton(text="16:9", callback_data="format_16_9"),
-        ],
-        [
-            InlineKeyboardButton(text="9:16", callback_data="format_9_16"),
-        ],
-        [InlineKeyboardButton(text="⬅ Назад", callback_data="generate")]
-    ])
-
-
-def after_generation_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎨 Сгенерировать изображение", callback_data="generate")],
-        [InlineKeyboardButton(text="🔁 Повторить", callback_data="generate")],
-        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_main")]
-    ])
-
-
 # ================= START =================
 
 @dp.message(CommandStart())
@@ -163,10 +146,10 @@ async def start(message: Message, state: FSMContext):
 
     user_id = message.from_user.id
 
-    user = get_user(user_id)
+    user = await get_user(user_id)
 
     if not user:
-        add_user(user_id)
+        await add_user(user_id)
 
     await message.answer(
         "✨ <b>LuxRender</b>\n\n"
@@ -277,7 +260,7 @@ async def choose_mode(callback: CallbackQuery):
 
     model = model_map.get(callback.data)
 
-    update_model(callback.from_user.id, model)
+    await update_model(callback.from_user.id, model)
 
     await callback.message.edit_text(
         "⚙ Выберите режим:",
@@ -307,7 +290,7 @@ async def after_format(callback: CallbackQuery, state: FSMContext):
 
     format_value = callback.data.replace("format_", "").replace("_", ":")
 
-    update_format(callback.from_user.id, format_value)
+    await update_format(callback.from_user.id, format_value)
 
     data = await state.get_data()
     mode = data.get("mode")
@@ -342,15 +325,9 @@ async def choose_model(callback: CallbackQuery, state: FSMContext):
 async def profile(callback: CallbackQuery):
 
     user_id = callback.from_user.id
-    balance = get_user(user_id)[0]
-
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT COUNT(*) FROM generations WHERE user_id=?",
-        (user_id,)
-    )
+    balance = (await get_user(user_id))[0]
 
-    total_generations = cursor.fetchone()[0]
+    total_generations = await get_user_generations_count(user_id)
 
     await callback.message.edit_text(
         f"👤 <b>Личный кабинет</b>\n\n"
@@ -386,16 +363,17 @@ async def topup(callback: CallbackQuery):
     )
 
     await callback.answer()
-@dp.message(Generate.waiting_prompt)
+@dp.message(Generate.waiting_prompt, flags={"rate_limit": "generation"})
 async def process_prompt(message: Message, state: FSMContext):
 
     user_id = message.from_user.id
 
-    user = get_user(user_id)
+    # без резервирования баланс проверяется здесь, поэтому читаем его из БД
+    user = await get_user(user_id, fresh=not BALANCE_RESERVE)
 
     if not user:
-        add_user(user_id)
-        user = get_user(user_id)
+        await add_user(user_id)
+        user = await get_user(user_id)
 
     balance, model, format_value = user
 
@@ -407,26 +385,68 @@ async def process_prompt(message: Message, state: FSMContext):
         return
 
     data = await state.get_data()
-    user_image = data.get("user_image")
+    photo = data.get("photo")
+
+    reserved = 0
+
+    # резервируем стоимость сразу, чтобы параллельные задачи не ушли в минус;
+    # картинку из кеша тоже отдаём только после списания
+    if BALANCE_RESERVE or cache_enabled(model):
+        if await reserve_balance(user_id, GENERATION_PRICE) is None:
+            await message.answer(
+                "❌ Недостаточно средств.",
+                reply_markup=main_menu()
+            )
+            return
+
+        reserved = GENERATION_PRICE
+
+    # повторный запрос — отдаём уже готовую картинку без генерации
+    if cache_enabled(model):
+        key = cache_key(message.text, model, format_value, image_key(photo))
+
+        if await deliver_cached(bot, redis, message.chat.id, user_id, model, key, reserved):
+            await log_event(user_id, "generation_cached")
+            await state.clear()
+            return
+
+        # без BALANCE_RESERVE задачу в очереди не держим на резерве —
+        # стоимость спишет worker перед генерацией
+        if not BALANCE_RESERVE:
+            await release_balance(user_id, reserved)
+            reserved = 0
 
     task = {
         "chat_id": message.chat.id,
         "prompt": message.text,
         "model": model,
         "format": format_value,
-        "image": user_image,
-        "user_id": user_id
+        "photo": photo,
+        "user_id": user_id,
+        "reserved": reserved,
+        "enqueued_at": time.time()
     }
 
-    await redis.rpush(GENERATION_QUEUE_KEY, json.dumps(task))
+    lane = choose_lane(model, await get_user_paid_total(user_id))
 
-    queue_size = await redis.llen(GENERATION_QUEUE_KEY)
+    try:
+        job_id = await submit(redis, task, lane)
+    except Exception:
+        if reserved:
+            await release_balance(user_id, reserved)
+        raise
 
-    await message.answer(
-        f"🎨 Генерирую изображение...\n"
-        f"⏳ Запрос добавлен в очередь\n"
-        f"Ваша позиция: {queue_size}"
-    )
+    # одно сообщение со статусом, позицию и ETA в нём обновляет status_updater:
+    # обход очереди в хендлере замедлял бы ответ под нагрузкой
+    status_message_text = "⏳ Запрос добавлен в очередь"
+    status_message = await message.answer(status_message_text)
+
+    await register(redis, job_id, message.chat.id, status_message.message_id, status_message_text)
+
+    # будим свободных worker, если они есть
+    await dispatch(redis)
+
+    await log_event(user_id, "generation_enqueued")
 
     await state.clear()
 @dp.message(Generate.waiting_image)
@@ -436,24 +456,23 @@ async def process_image(message: Message, state: FSMContext):
         await message.answer("❌ Отправьте изображение.")
         return
 
-    photo = message.photo[-1]
-
-    file = await bot.get_file(photo.file_id)
-    file_bytes = await bot.download_file(file.file_path)
-
-    image_base64 = base64.b64encode(file_bytes.read()).decode()
-
-    await state.update_data(user_image=image_base64)
+    # скачиваем фото не здесь, а в worker, когда дойдёт очередь
+    await state.update_data(photo=photo_meta(message.photo[-1]))
 
     await message.answer("✍ Теперь напишите промпт:")
     await state.set_state(Generate.waiting_prompt)
-@dp.callback_query(F.data.startswith("pay_"))
+@dp.callback_query(F.data.startswith("pay_"), flags={"rate_limit": "payment"})
 async def create_payment_handler(callback: CallbackQuery):
 
     amount = int(callback.data.split("_")[1])
     user_id = callback.from_user.id
 
-    payment = create_payment(user_id, amount)
+    try:
+        payment = await create_payment(redis, user_id, amount)
+    except Exception:
+        logging.exception("Payment creation error")
+        await callback.answer("❌ Не удалось создать платёж. Попробуйте позже.", show_alert=True)
+        return
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💳 Оплатить", url=payment["payment_url"])],
@@ -471,83 +490,26 @@ async def create_payment_handler(callback: CallbackQuery):
 # ================= АДМИН =================
 
 
-async def generation_worker():
-
-    while True:
-
-        try:
-
-            data = await redis.blpop(GENERATION_QUEUE_KEY)
-
-            task = json.loads(data[1].decode())
-
-            chat_id = task["chat_id"]
-            prompt = task["prompt"]
-            model = task["model"]
-            format_value = task["format"]
-            user_image = task["image"]
-            user_id = task["user_id"]
-
-            result = await generate_image_openrouter(
-                prompt=prompt,
-                model=model,
-                format_value=format_value,
-                user_image=user_image
-            )
-
-            if not result or "image_bytes" not in result:
-
-                await bot.send_message(
-                    chat_id,
-                    "❌ Ошибка генерации.\nПопробуйте снова.",
-                    reply_markup=after_generation_menu()
-                )
-
-                continue
-
-            image = Image.open(BytesIO(result["image_bytes"])).convert("RGB")
-
-            buffer = BytesIO()
-            image.save(buffer, format="JPEG")
-            buffer.seek(0)
-
-            file = BufferedInputFile(buffer.read(), filename="image.jpg")
-
-            await bot.send_photo(chat_id, file)
-
-            deduct_balance(user_id, GENERATION_PRICE)
-            add_generation(user_id, model)
-
-            new_balance = get_user(user_id)[0]
-
-            await bot.send_message(
-                chat_id,
-                f"✅ Готово!\n💎 Остаток: {new_balance}₽",
-                reply_markup=after_generation_menu()
-            )
-
-        except Exception as e:
-
-            logging.exception("Worker error")
-
-            # ждём и перезапускаем worker
-            await asyncio.sleep(5)
 @dp.message(Command("stats"))
 async def admin_stats(message: Message):
 
     if message.from_user.id != ADMIN_ID:
         return
 
-    users = get_users_count()
-    generations = get_generations_count()
-    payments_count, payments_sum = get_payments_stats()
+    users = await get_users_count()
+    generations = await get_generations_count()
+    payments_count, payments_sum = await get_payments_stats()
+    user_cache = cache_stats()
+    upstream = limits()["upstream"]
 
     await message.answer(
         f"📊 Статистика\n\n"
         f"👥 Пользователей: {users}\n"
         f"🎨 Генераций: {generations}\n"
         f"💳 Платежей: {payments_count}\n"
-        f"💰 Доход: {payments_sum}₽"
+        f"💰 Доход: {payments_sum}₽\n"
+        f"🗂 Кеш профилей: {user_cache['hit_rate']:.0%} попаданий\n"
+        f"⚙️ OpenRouter: {upstream['inflight']}/{upstream['limit']} параллельно"
     )
 
 
@@ -559,7 +521,7 @@ async def admin_add_balance(message: Message):
 
     try:
         _, user_id, amount = message.text.split()
-        update_balance(int(user_id), int(amount))
+        await update_balance(int(user_id), int(amount))
         await message.answer("Баланс обновлён.")
     except BaseException:
         await message.answer("Формат: /addbalance USER_ID СУММА")
@@ -572,17 +534,9 @@ async def admin_broadcast(message: Message):
         return
 
     text = message.text.replace("/broadcast ", "")
-    users = get_all_user_ids()
 
-    sent = 0
-    for user_id in users:
-        try:
-            await bot.send_message(user_id, text)
-            sent += 1
-        except BaseException:
-            pass
-
-    await message.answer(f"Рассылка завершена. Отправлено: {sent}")
+    # рассылка идёт в фоне, прогресс обновляется в отдельном сообщении
+    await start_broadcast(bot, redis, message.chat.id, text)
 
 
 @dp.message(Command("logs"))
@@ -597,19 +551,79 @@ async def admin_logs(message: Message):
         await message.answer("\n".join(ERROR_LOG[-10:]))
 
 
+@dp.message(Command("profiler"))
+async def admin_profiler(message: Message, command: CommandObject):
+
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    # /profiler [секунды] [all] — all добавляет потоки БД и пулов
+    args = (command.args or "").split()
+
+    try:
+        seconds = int(args[0]) if args else 10
+    except ValueError:
+        await message.answer("Формат: /profiler СЕКУНДЫ [all]")
+        return
+
+    await message.answer(f"🔬 Профилирую {seconds} сек...")
+
+    try:
+        report = await run_profiler(seconds, all_threads="all" in args)
+    except ProfilerBusy:
+        await message.answer("Профайлер уже запущен.")
+        return
+
+    if not report:
+        await message.answer("Нет сэмплов.")
+        return
+
+    await message.answer_document(
+        BufferedInputFile(report.encode(), filename=f"profile-{int(time.time())}.folded"),
+        caption="Folded stacks: flamegraph.pl / speedscope.app"
+    )
+
+
 # ================= WEBHOOK =================
 
 async def on_startup(app):
 
     await bot.set_webhook(WEBHOOK_URL)
-  # запускаем несколько worker
-    for _ in range(3):
-        asyncio.create_task(generation_worker())
+
+    # общий пул соединений к OpenRouter
+    await init_session()
+    await init_payment_session()
+    await init_queue(redis)
+
+    configure_user_cache(redis)
+    app["user_cache_listener"] = asyncio.create_task(listen_invalidations())
+    app["notification_worker"] = asyncio.create_task(notification_worker(bot, redis))
+    app["status_updater"] = asyncio.create_task(status_updater(bot, redis))
+
+    await resume_broadcasts(bot, redis)
+
+    # worker внутри webhook-процесса; при GENERATION_WORKERS=0 генерацией занимается worker.py
+    if GENERATION_WORKERS > 0:
+        start_workers(bot, redis, GENERATION_WORKERS)
+
+    # внутренний /metrics без токена на отдельном порту
+    app["metrics_runner"] = await start_metrics_server(METRICS_PORT) if METRICS_PORT else None
 
 
 async def on_shutdown(app):
 
     await bot.delete_webhook()
+    app["user_cache_listener"].cancel()
+    app["notification_worker"].cancel()
+    app["status_updater"].cancel()
+    await stop_workers()
+
+    if app["metrics_runner"] is not None:
+        await app["metrics_runner"].cleanup()
+
+    await close_session()
+    await close_payment_session()
+    await close_db()
     await bot.session.close()
 
 
@@ -619,7 +633,7 @@ async def yookassa_webhook(request):
 
     body = await request.read()
 
-    signature = request.headers.get("Yookassa-Signature")
+    signature = request.headers.get("Yookassa-Signature", "")
 
     secret_key = os.getenv("YOOKASSA_SECRET_KEY")
 
@@ -629,59 +643,68 @@ async def yookassa_webhook(request):
         hashlib.sha256
     ).hexdigest()
 
-    if signature != generated_signature:
+    if not hmac.compare_digest(signature, generated_signature):
+        PAYMENT_WEBHOOKS.labels("invalid_signature").inc()
         return web.Response(text="invalid signature", status=403)
 
-    data = await request.json()
+    data = json.loads(body)
 
     event = data.get("event")
     obj = data.get("object", {})
 
     if event != "payment.succeeded":
+        PAYMENT_WEBHOOKS.labels("ignored").inc()
         return web.Response(text="ignored")
 
     payment_id = obj["id"]
     amount = int(float(obj["amount"]["value"]))
     user_id = int(obj["metadata"]["user_id"])
 
-    cursor.execute(
-        "SELECT payment_id FROM payments WHERE payment_id=?",
-        (payment_id,)
-    )
-
-    exists = cursor.fetchone()
-
-    if exists:
-        return web.Response(text="already processed")
-
     bonus = BONUS_TABLE.get(amount, 0)
     total_amount = amount + bonus
 
-    cursor.execute(
-        "INSERT INTO payments (payment_id, user_id, amount, status) VALUES (?, ?, ?, ?)",
-        (payment_id, user_id, amount, "success")
-    )
-
-    conn.commit()
-
-    update_balance(user_id, total_amount)
+    # запись платежа и зачисление — одна транзакция, повторы YooKassa безопасны
+    if await credit_payment(payment_id, user_id, amount, total_amount) is None:
+        PAYMENT_WEBHOOKS.labels("duplicate").inc()
+        return web.Response(text="already processed")
 
+    # деньги уже зачислены: ошибка дальше не должна давать YooKassa 500 —
+    # повтор вернул бы «already processed», и уведомление не ушло бы никогда.
+    # Уведомление уходит в фоне, YooKassa получает ответ сразу
     try:
-        await bot.send_message(
+        await notify(
+            redis,
             user_id,
             f"💳 <b>Платёж получен!</b>\n\n"
             f"Баланс пополнен на <b>{total_amount}₽</b>\n"
-            f"Бонус: <b>{bonus}₽</b>",
-            parse_mode="HTML"
+            f"Бонус: <b>{bonus}₽</b>"
         )
-    except BaseException:
-        pass
+    except Exception:
+        logging.exception(f"Payment notification for {user_id} not queued")
 
+    try:
+        await forget_pending(redis, user_id, amount)
+    except Exception:
+        logging.exception(f"Pending payment cleanup for {user_id} failed")
+
+    PAYMENT_WEBHOOKS.labels("credited").inc()
     logging.warning(f"Payment success: {user_id} +{total_amount}")
 
     return web.Response(text="OK")
 
 
+# ================= METRICS =================
+
+async def collect_queue_metrics():
+    for stage, count in (await queue_depth(redis)).items():
+        QUEUE_DEPTH.labels(stage).set(count)
+
+
+register_collector(collect_queue_metrics)
+register_collector(collect_limit_metrics)
+register_collector(collect_cache_metrics)
+
+
 # ================= MINI APP PAGES =================
 
 async def privacy_page(request):
@@ -701,11 +724,16 @@ app.router.add_get("/terms", terms_page)
 
 app.router.add_post("/yookassa", yookassa_webhook)
 
+app.router.add_get("/metrics", metrics_handler)
+
+# on_shutdown регистрируем раньше aiogram: он закрывает Redis хранилища FSM,
+# а worker и фоновые задачи должны остановиться до этого
+app.on_shutdown.append(on_shutdown)
+
 SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path=WEBHOOK_PATH)
 setup_application(app, dp, bot=bot)
 
 app.on_startup.append(on_startup)
-app.on_shutdown.append(on_shutdown)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,301 @@
+import os
+import time
+import socket
+import uuid
+import asyncio
+import logging
+
+from aiogram.exceptions import (
+    TelegramRetryAfter,
+    TelegramForbiddenError,
+    TelegramBadRequest,
+)
+
+from database import get_user_ids_page
+
+# Рассылка: id пользователей читаются из БД страницами, сообщения уходят
+# параллельно с ограничением скорости. Прогресс хранится в Redis,
+# поэтому после рестарта рассылка продолжается с последней страницы.
+
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 20))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", 500))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 5))
+BROADCAST_MAX_RETRIES = 3
+
+BROADCAST_ACTIVE_KEY = "broadcast:active"
+BROADCAST_LOCK_TTL = 60
+
+# владелец блокировки: после падения процесса его блокировка
+# ещё живёт до TTL, и новый процесс не должен её снимать или продлевать
+_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# продлить / снять блокировку, только если она всё ещё наша
+_REFRESH_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_running = set()
+
+
+def _job_key(job_id):
+    return f"broadcast:{job_id}"
+
+
+class RateLimiter:
+
+    # refresh — корутина, продлевающая блокировку рассылки: страница
+    # с паузой по RetryAfter может идти дольше BROADCAST_LOCK_TTL
+    def __init__(self, rate, refresh=None, refresh_interval=BROADCAST_LOCK_TTL / 3):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+        self.paused_until = 0.0
+        self.refresh = refresh
+        self.refresh_interval = refresh_interval
+        self.refreshed_at = time.monotonic()
+
+    async def _refresh(self):
+
+        if self.refresh is None or time.monotonic() - self.refreshed_at < self.refresh_interval:
+            return
+
+        self.refreshed_at = time.monotonic()
+
+        try:
+            await self.refresh()
+        except Exception:
+            logging.exception("Broadcast lock refresh error")
+
+    async def wait(self):
+        await self._refresh()
+
+        now = time.monotonic()
+
+        slot = max(now, self.next_slot, self.paused_until)
+        self.next_slot = slot + self.interval
+
+        # долгую паузу спим частями, не давая блокировке истечь
+        while slot > now:
+            await asyncio.sleep(min(slot - now, self.refresh_interval))
+            await self._refresh()
+            now = time.monotonic()
+
+    def pause(self, seconds):
+        # RetryAfter касается всего бота, поэтому притормаживаем всех отправителей
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+async def _send(bot, limiter, user_id, text):
+
+    for _ in range(BROADCAST_MAX_RETRIES):
+
+        await limiter.wait()
+
+        try:
+            await bot.send_message(user_id, text)
+            return "sent"
+
+        except TelegramRetryAfter as e:
+            logging.warning(f"Broadcast flood control, sleeping {e.retry_after}s")
+            limiter.pause(e.retry_after)
+
+        except TelegramForbiddenError:
+            return "blocked"
+
+        except TelegramBadRequest:
+            return "failed"
+
+        except Exception:
+            logging.exception(f"Broadcast send error for {user_id}")
+            return "failed"
+
+    return "failed"
+
+
+def _progress_text(job, title="⏳ Рассылка идёт..."):
+    return (
+        f"{title}\n\n"
+        f"Отправлено: {job['sent']}\n"
+        f"Заблокировали бота: {job['blocked']}\n"
+        f"Ошибок: {job['failed']}"
+    )
+
+
+async def _report(bot, job):
+    try:
+        await bot.edit_message_text(
+            _progress_text(job),
+            chat_id=job["admin_chat_id"],
+            message_id=job["message_id"]
+        )
+    except Exception:
+        pass
+
+
+async def _load_job(redis, job_id):
+    raw = await redis.hgetall(_job_key(job_id))
+
+    if not raw:
+        return None
+
+    job = {k.decode(): v.decode() for k, v in raw.items()}
+
+    for field in ("admin_chat_id", "message_id", "cursor", "sent", "blocked", "failed"):
+        job[field] = int(job[field])
+
+    return job
+
+
+async def _acquire(redis, job_id, lock_key):
+
+    # защита от одновременного запуска одной рассылки на нескольких репликах.
+    # Блокировку упавшего процесса ждём до истечения TTL; живой владелец
+    # её продлевает, и мы ждём, пока рассылка не уйдёт из broadcast:active
+    while not await redis.set(lock_key, _OWNER, nx=True, ex=BROADCAST_LOCK_TTL):
+
+        if not await redis.sismember(BROADCAST_ACTIVE_KEY, job_id):
+            return False
+
+        ttl = await redis.pttl(lock_key)
+        logging.warning(f"Broadcast {job_id} is locked by {await redis.get(lock_key)}, retrying")
+
+        await asyncio.sleep(max(ttl, 1000) / 1000)
+
+    return True
+
+
+async def _run(bot, redis, job_id):
+
+    lock_key = f"{_job_key(job_id)}:lock"
+
+    if not await _acquire(redis, job_id, lock_key):
+        return
+
+    job = None
+
+    try:
+        job = await _load_job(redis, job_id)
+
+        if job is None:
+            await redis.srem(BROADCAST_ACTIVE_KEY, job_id)
+            return
+
+        limiter = RateLimiter(
+            BROADCAST_RATE,
+            lambda: redis.eval(_REFRESH_LOCK, 1, lock_key, _OWNER, BROADCAST_LOCK_TTL)
+        )
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        last_report = 0.0
+
+        async def send_one(user_id):
+            async with semaphore:
+                return await _send(bot, limiter, user_id, job["text"])
+
+        while True:
+
+            user_ids = await get_user_ids_page(job["cursor"], BROADCAST_PAGE_SIZE)
+
+            if not user_ids:
+                break
+
+            results = await asyncio.gather(*[send_one(user_id) for user_id in user_ids])
+
+            for result in results:
+                job[result] += 1
+
+            job["cursor"] = user_ids[-1]
+
+            # курсор и счётчики сохраняем после каждой страницы
+            await redis.hset(_job_key(job_id), mapping={
+                "cursor": job["cursor"],
+                "sent": job["sent"],
+                "blocked": job["blocked"],
+                "failed": job["failed"],
+            })
+
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                await _report(bot, job)
+
+        await redis.srem(BROADCAST_ACTIVE_KEY, job_id)
+        await redis.hset(_job_key(job_id), "status", "done")
+
+        await bot.send_message(job["admin_chat_id"], _progress_text(job, "Рассылка завершена."))
+
+    except asyncio.CancelledError:
+        # остановка процесса — рассылка продолжится после рестарта
+        raise
+
+    except Exception:
+        logging.exception(f"Broadcast {job_id} failed")
+        await _abort(bot, redis, job_id, job)
+
+    finally:
+        await redis.eval(_RELEASE_LOCK, 1, lock_key, _OWNER)
+
+
+async def _abort(bot, redis, job_id, job):
+
+    # упавшую рассылку не перезапускаем по кругу, курсор остаётся в Redis
+    try:
+        await redis.srem(BROADCAST_ACTIVE_KEY, job_id)
+        await redis.hset(_job_key(job_id), "status", "failed")
+    except Exception:
+        logging.exception(f"Broadcast {job_id} state cleanup failed")
+
+    if job is None:
+        return
+
+    try:
+        await bot.send_message(
+            job["admin_chat_id"],
+            _progress_text(job, "❌ Рассылка остановлена из-за ошибки.")
+        )
+    except Exception:
+        logging.exception(f"Broadcast {job_id} failure notice not sent")
+
+
+def _spawn(bot, redis, job_id):
+    task = asyncio.create_task(_run(bot, redis, job_id))
+    _running.add(task)
+    task.add_done_callback(_running.discard)
+
+
+async def start_broadcast(bot, redis, admin_chat_id, text):
+
+    job_id = uuid.uuid4().hex
+
+    status = await bot.send_message(admin_chat_id, "⏳ Рассылка запущена...")
+
+    await redis.hset(_job_key(job_id), mapping={
+        "text": text,
+        "admin_chat_id": admin_chat_id,
+        "message_id": status.message_id,
+        "cursor": 0,
+        "sent": 0,
+        "blocked": 0,
+        "failed": 0,
+        "status": "running",
+    })
+    await redis.sadd(BROADCAST_ACTIVE_KEY, job_id)
+
+    _spawn(bot, redis, job_id)
+
+    return job_id
+
+
+async def resume_broadcasts(bot, redis):
+
+    for job_id in await redis.smembers(BROADCAST_ACTIVE_KEY):
+        logging.warning(f"Resuming broadcast {job_id.decode()}")
+        _spawn(bot, redis, job_id.decode())
@@ -0,0 +1,205 @@
+import os
+import time
+import asyncio
+
+from metrics import UPSTREAM_SECONDS, UPSTREAM_ERRORS, UPSTREAM_LIMIT, UPSTREAM_INFLIGHT
+
+# Адаптивный лимит параллельных запросов к OpenRouter (AIMD).
+#
+# Успешный быстрый ответ увеличивает лимит на 1/limit (≈ +1 за «окно»
+# запросов), 429/5xx/таймаут уменьшают его вдвое, заметный рост задержки
+# относительно базовой — на 10%. Уменьшение не чаще раза за время ответа,
+# чтобы пачка ошибок от одной перегрузки не сбросила лимит до минимума.
+#
+# Лимиты два уровня: общий (worker берёт задачу из очереди, только пока
+# есть свободный слот) и по каждой модели (вокруг самого запроса).
+# Потолок общего лимита — настройка процесса (GENERATION_WORKERS /
+# WORKER_CONCURRENCY): AIMD снижает параллельность под перегрузкой и
+# возвращает её, но выше заданной не поднимает.
+
+UPSTREAM_MIN_CONCURRENCY = int(os.getenv("UPSTREAM_MIN_CONCURRENCY", 1))
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", 12))
+MODEL_MAX_CONCURRENCY = int(os.getenv("MODEL_MAX_CONCURRENCY", UPSTREAM_MAX_CONCURRENCY))
+
+UPSTREAM_BACKOFF = float(os.getenv("UPSTREAM_BACKOFF", 0.5))
+UPSTREAM_LATENCY_BACKOFF = float(os.getenv("UPSTREAM_LATENCY_BACKOFF", 0.9))
+
+# во сколько раз сглаженная задержка может превысить базовую без уменьшения лимита
+UPSTREAM_LATENCY_TOLERANCE = float(os.getenv("UPSTREAM_LATENCY_TOLERANCE", 2.0))
+
+# базовая задержка — минимум, который медленно «забывается»
+_BASELINE_DRIFT = 1.01
+_EWMA_ALPHA = 0.2
+
+OK = "ok"
+OVERLOAD = "overload"
+ERROR = "error"
+
+
+def classify(result):
+
+    if result and "image_bytes" in result:
+        return OK
+
+    status = (result or {}).get("status")
+
+    # перегрузка апстрима — повод снизить параллельность
+    if status == 429 or status == "timeout" or (isinstance(status, int) and status >= 500):
+        return OVERLOAD
+
+    # ошибки запроса (модерация, неверный ответ) о нагрузке ничего не говорят
+    return ERROR
+
+
+class AdaptiveLimiter:
+
+    def __init__(self, name, initial, minimum, maximum):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.inflight = 0
+        self.closed = False
+
+        self._baseline = None
+        self._latency = None
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.closed or self.inflight < int(self.limit))
+            self.inflight += 1
+
+    async def close(self):
+        # будим всех ожидающих — например, worker при остановке
+        async with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    async def release(self):
+        async with self._condition:
+            self.inflight -= 1
+            self._condition.notify_all()
+
+    def observe(self, outcome, latency):
+
+        if outcome == OK:
+            self._latency = latency if self._latency is None else (
+                _EWMA_ALPHA * latency + (1 - _EWMA_ALPHA) * self._latency
+            )
+
+            if self._baseline is None or latency < self._baseline:
+                self._baseline = latency
+            else:
+                self._baseline *= _BASELINE_DRIFT
+
+            if self._latency > self._baseline * UPSTREAM_LATENCY_TOLERANCE:
+                self._decrease(UPSTREAM_LATENCY_BACKOFF)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+        elif outcome == OVERLOAD:
+            self._decrease(UPSTREAM_BACKOFF)
+
+    def _decrease(self, factor):
+        now = time.monotonic()
+
+        if now - self._last_decrease < (self._latency or 1.0):
+            return
+
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * factor)
+
+    def snapshot(self):
+        return {
+            "limit": int(self.limit),
+            "inflight": self.inflight,
+            "latency": round(self._latency, 2) if self._latency is not None else None,
+        }
+
+
+_upstream = None
+_models = {}
+
+
+def configure(maximum):
+    global _upstream
+
+    _upstream = AdaptiveLimiter("upstream", maximum, min(UPSTREAM_MIN_CONCURRENCY, maximum), maximum)
+    return _upstream
+
+
+def upstream():
+
+    if _upstream is None:
+        configure(UPSTREAM_MAX_CONCURRENCY)
+
+    return _upstream
+
+
+def model_limiter(model):
+
+    limiter = _models.get(model)
+
+    if limiter is None:
+        # новая модель стартует с текущего общего лимита
+        limiter = AdaptiveLimiter(
+            model,
+            upstream().limit,
+            UPSTREAM_MIN_CONCURRENCY,
+            MODEL_MAX_CONCURRENCY
+        )
+        _models[model] = limiter
+
+    return limiter
+
+
+async def call(model, func, *args, **kwargs):
+
+    limiter = model_limiter(model)
+    await limiter.acquire()
+
+    started = time.monotonic()
+    result = None
+
+    try:
+        result = await func(*args, **kwargs)
+        return result
+
+    finally:
+        outcome = classify(result)
+        latency = time.monotonic() - started
+
+        limiter.observe(outcome, latency)
+        upstream().observe(outcome, latency)
+
+        UPSTREAM_SECONDS.labels(model, outcome).observe(latency)
+
+        if outcome != OK:
+            UPSTREAM_ERRORS.labels(model, str((result or {}).get("status"))).inc()
+
+        await limiter.release()
+
+
+def _requests_inflight():
+    # слот общего лимита worker держит и пока ждёт задачу в XREADGROUP,
+    # поэтому запросы к OpenRouter считаем по лимитам моделей вокруг call()
+    return sum(limiter.inflight for limiter in _models.values())
+
+
+async def collect_metrics():
+    for scope, limiter in [("upstream", upstream()), *_models.items()]:
+        UPSTREAM_LIMIT.labels(scope).set(int(limiter.limit))
+
+    UPSTREAM_INFLIGHT.labels("upstream").set(_requests_inflight())
+
+    for model, limiter in _models.items():
+        UPSTREAM_INFLIGHT.labels(model).set(limiter.inflight)
+
+
+def limits():
+    return {
+        "upstream": {**upstream().snapshot(), "inflight": _requests_inflight()},
+        "models": {model: limiter.snapshot() for model, limiter in _models.items()},
+    }
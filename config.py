@@ -0,0 +1,24 @@
+import os
+
+# ================= НАСТРОЙКИ =================
+
+TOKEN = os.getenv("BOT_TOKEN")
+PUBLIC_DOMAIN = os.getenv("RAILWAY_PUBLIC_DOMAIN")
+REDIS_URL = os.getenv("REDIS_PUBLIC_URL")
+
+# свой сервер Bot API (local bot-api или заглушка нагрузочного теста), по умолчанию api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+CHANNEL_USERNAME = "YourDesignerSpb"
+ADMIN_ID = 373830941
+
+GENERATION_PRICE = 10
+
+# резервировать стоимость при постановке в очередь и списывать/возвращать по итогу
+BALANCE_RESERVE = os.getenv("BALANCE_RESERVE", "1") == "1"
+
+# сколько worker запускать внутри webhook-процесса (0 — только отдельный worker.py)
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", 3))
+
+# сколько задач параллельно обрабатывает один процесс worker.py
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 3))
@@ -1,149 +1,748 @@
+import os
+import time
+import asyncio
+import logging
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-conn = sqlite3.connect("database.db", check_same_thread=False)
-cursor = conn.cursor()
-
-# ================= USERS ================= #
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    balance INTEGER DEFAULT 0,
-    model TEXT DEFAULT 'google/gemini-2.5-flash-image',
-    format TEXT DEFAULT '1:1'
-)
-""")
-
-# ================= PAYMENTS ================= #
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS payments (
-    payment_id TEXT PRIMARY KEY,
-    user_id INTEGER,
-    amount INTEGER,
-    status TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-""")
-# ================= GENERATIONS ================= #
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS generations (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    model TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-""")
-
-conn.commit()
+from metrics import DB_SECONDS
+from timing import add as add_timing
+
+DB_PATH = os.getenv("DATABASE_PATH", "database.db")
+DB_THREADS = int(os.getenv("DB_THREADS", 4))
+DB_BUSY_TIMEOUT = int(os.getenv("DB_BUSY_TIMEOUT", 5000))
+
+# отложенная пакетная запись нефинансовых вставок (generations, usage_events)
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", 200))
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", 0.5))
+WRITE_BEHIND_CLOSE_RETRIES = 3
+
+# Все запросы выполняются в отдельных потоках, event loop не блокируется.
+# У каждого потока своё соединение, курсор создаётся на каждый вызов.
+_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT / 1000, check_same_thread=False)
+
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-16000")
+    conn.execute("PRAGMA mmap_size=134217728")
+
+    return conn
+
+
+def _get_conn():
+    conn = getattr(_local, "conn", None)
+
+    if conn is None:
+        conn = _connect()
+        _local.conn = conn
+
+        with _connections_lock:
+            _connections.append(conn)
+
+    return conn
+
+
+async def _run(func, *args):
+    loop = asyncio.get_running_loop()
+
+    # для транзакций метка — имя функции внутри, а не общий _transaction
+    op = (args[0] if func is _transaction else func).__name__.lstrip("_")
+    started = time.perf_counter()
+
+    try:
+        return await loop.run_in_executor(_executor, func, *args)
+    finally:
+        elapsed = time.perf_counter() - started
+        DB_SECONDS.labels(op).observe(elapsed)
+        add_timing("db", elapsed)
+
+
+def _fetchone(sql, params=()):
+    cursor = _get_conn().cursor()
+    try:
+        cursor.execute(sql, params)
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def _fetchall(sql, params=()):
+    cursor = _get_conn().cursor()
+    try:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def _write(sql, params=()):
+    conn = _get_conn()
+    cursor = conn.cursor()
+    try:
+        with conn:
+            cursor.execute(sql, params)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def _transaction(func, *args):
+    conn = _get_conn()
+    cursor = conn.cursor()
+    try:
+        with conn:
+            return func(cursor, *args)
+    finally:
+        cursor.close()
+
+
+async def fetchone(sql, params=()):
+    return await _run(_fetchone, sql, params)
+
+
+async def fetchall(sql, params=()):
+    return await _run(_fetchall, sql, params)
+
+
+async def execute(sql, params=()):
+    return await _run(_write, sql, params)
+
+
+# выполняет func(cursor, *args) в одной транзакции с одним commit
+async def transaction(func, *args):
+    return await _run(_transaction, func, *args)
+
+
+# ================= WRITE-BEHIND ================= #
+
+def _executemany(cursor, batch):
+    # группируем подряд идущие одинаковые запросы в executemany
+    sql, rows = None, []
+
+    for item_sql, params in batch:
+        if item_sql != sql and rows:
+            cursor.executemany(sql, rows)
+            rows = []
+
+        sql = item_sql
+        rows.append(params)
+
+    if rows:
+        cursor.executemany(sql, rows)
+
+
+class WriteBehindBuffer:
+
+    def __init__(self, max_batch=WRITE_BEHIND_MAX_BATCH, interval=WRITE_BEHIND_INTERVAL):
+        self.max_batch = max_batch
+        self.interval = interval
+        self.pending = []
+        self.closed = False
+        self._timer = None
+        self._flushes = set()
+
+    def add(self, sql, params):
+        self.pending.append((sql, params))
+
+        if len(self.pending) >= self.max_batch:
+            self._spawn_flush()
+
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self._spawn_flush)
+
+    def _spawn_flush(self):
+        task = asyncio.create_task(self.flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self.pending = self.pending, []
+
+        if not batch:
+            return
+
+        try:
+            # весь пакет — одна транзакция и один fsync
+            await transaction(_executemany, batch)
+        except Exception:
+            logging.exception(f"Write-behind flush failed, {len(batch)} rows requeued")
+            self.pending[:0] = batch
+
+            # повторяем по таймеру, а не со следующей вставкой, которой может и не быть
+            if self._timer is None and not self.closed:
+                self._timer = asyncio.get_running_loop().call_later(self.interval, self._spawn_flush)
+
+    async def close(self):
+        self.closed = True
+
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+        for _ in range(WRITE_BEHIND_CLOSE_RETRIES):
+            await self.flush()
+
+            if not self.pending:
+                return
+
+            await asyncio.sleep(self.interval)
+
+        # строки остаются только в логе — по нему их можно дописать вручную
+        logging.error(f"Write-behind closed with {len(self.pending)} unsaved rows: {self.pending}")
+
+
+write_behind = WriteBehindBuffer() if WRITE_BEHIND else None
+
+
+async def close_db():
+    if write_behind is not None:
+        await write_behind.close()
+
+    _executor.shutdown(wait=True)
+
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+
+
+# ================= SCHEMA ================= #
+
+SCHEMA_VERSION = 1
+
+
+def _migrate_stats(conn):
+
+    # ================= INDEXES ================= #
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_generations_user_id ON generations(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payments(user_id)")
+
+    # ================= COUNTERS ================= #
+
+    # счётчики обновляются триггерами в той же транзакции, что и сами записи,
+    # поэтому /stats и личный кабинет не делают COUNT(*) по большим таблицам
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id INTEGER PRIMARY KEY,
+        generations INTEGER NOT NULL DEFAULT 0,
+        paid_total INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_stats_generations ON user_stats(generations)")
+
+    # заполняем счётчики по уже существующим данным
+    conn.execute("""
+    INSERT OR REPLACE INTO counters (name, value)
+    SELECT 'users', COUNT(*) FROM users
+    UNION ALL SELECT 'generations', COUNT(*) FROM generations
+    UNION ALL SELECT 'payments_count', COUNT(*) FROM payments WHERE status = 'success'
+    UNION ALL SELECT 'payments_sum', COALESCE(SUM(amount), 0) FROM payments WHERE status = 'success'
+    """)
+
+    conn.execute("""
+    INSERT OR REPLACE INTO user_stats (user_id, generations, paid_total)
+    SELECT user_id, SUM(generations), SUM(paid_total) FROM (
+        SELECT user_id, COUNT(*) AS generations, 0 AS paid_total
+        FROM generations GROUP BY user_id
+        UNION ALL
+        SELECT user_id, 0, SUM(amount)
+        FROM payments WHERE status = 'success' GROUP BY user_id
+    ) GROUP BY user_id
+    """)
+
+    # ================= TRIGGERS ================= #
+
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_insert AFTER INSERT ON users
+    BEGIN
+        UPDATE counters SET value = value + 1 WHERE name = 'users';
+    END
+    """)
+
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_delete AFTER DELETE ON users
+    BEGIN
+        UPDATE counters SET value = value - 1 WHERE name = 'users';
+    END
+    """)
+
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_generations_insert AFTER INSERT ON generations
+    BEGIN
+        UPDATE counters SET value = value + 1 WHERE name = 'generations';
+
+        INSERT INTO user_stats (user_id, generations) VALUES (NEW.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET generations = generations + 1;
+    END
+    """)
+
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_generations_delete AFTER DELETE ON generations
+    BEGIN
+        UPDATE counters SET value = value - 1 WHERE name = 'generations';
+        UPDATE user_stats SET generations = generations - 1 WHERE user_id = OLD.user_id;
+    END
+    """)
+
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_payments_insert AFTER INSERT ON payments
+    WHEN NEW.status = 'success'
+    BEGIN
+        UPDATE counters SET value = value + 1 WHERE name = 'payments_count';
+        UPDATE counters SET value = value + NEW.amount WHERE name = 'payments_sum';
+
+        INSERT INTO user_stats (user_id, paid_total) VALUES (NEW.user_id, NEW.amount)
+        ON CONFLICT(user_id) DO UPDATE SET paid_total = paid_total + NEW.amount;
+    END
+    """)
+
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_payments_success AFTER UPDATE OF status ON payments
+    WHEN OLD.status IS NOT 'success' AND NEW.status = 'success'
+    BEGIN
+        UPDATE counters SET value = value + 1 WHERE name = 'payments_count';
+        UPDATE counters SET value = value + NEW.amount WHERE name = 'payments_sum';
+
+        INSERT INTO user_stats (user_id, paid_total) VALUES (NEW.user_id, NEW.amount)
+        ON CONFLICT(user_id) DO UPDATE SET paid_total = paid_total + NEW.amount;
+    END
+    """)
+
+
+def _init_schema():
+    conn = _connect()
+    conn.isolation_level = None
+
+    # webhook и worker могут стартовать одновременно — схема создаётся под блокировкой
+    conn.execute("BEGIN IMMEDIATE")
+
+    # ================= USERS ================= #
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        balance INTEGER DEFAULT 0,
+        model TEXT DEFAULT 'google/gemini-2.5-flash-image',
+        format TEXT DEFAULT '1:1'
+    )
+    """)
+
+    # ================= PAYMENTS ================= #
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS payments (
+        payment_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        amount INTEGER,
+        status TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    # ================= GENERATIONS ================= #
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS generations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        model TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    # ================= USAGE EVENTS ================= #
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS usage_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        event TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    # ================= JOB PAYMENTS ================= #
+
+    # деньги по задаче очереди: повторная доставка задачи не должна
+    # вернуть резерв дважды
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS job_payments (
+        job_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        amount INTEGER,
+        state TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    if version < 1:
+        _migrate_stats(conn)
+
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    conn.execute("COMMIT")
+    conn.close()
+
+
+_init_schema()
 
 # ================= USER FUNCTIONS ================= #
 
-def add_user(user_id: int):
-    cursor.execute(
+async def add_user(user_id: int):
+    await execute(
         "INSERT OR IGNORE INTO users (user_id, balance) VALUES (?, ?)",
         (user_id, 50)
     )
-    conn.commit()
 
 
-def get_user(user_id: int):
-    cursor.execute(
+async def get_user(user_id: int):
+    return await fetchone(
         "SELECT balance, model, format FROM users WHERE user_id = ?",
         (user_id,)
     )
-    return cursor.fetchone()
 
 
-def update_model(user_id: int, model: str):
-    cursor.execute(
+async def update_model(user_id: int, model: str):
+    await execute(
         "UPDATE users SET model = ? WHERE user_id = ?",
         (model, user_id)
     )
-    conn.commit()
 
 
-def update_format(user_id: int, format_value: str):
-    cursor.execute(
+async def update_format(user_id: int, format_value: str):
+    await execute(
         "UPDATE users SET format = ? WHERE user_id = ?",
         (format_value, user_id)
     )
-    conn.commit()
 
 
-def update_balance(user_id: int, amount: int):
-    cursor.execute(
+async def update_balance(user_id: int, amount: int):
+    await execute(
         "UPDATE users SET balance = balance + ? WHERE user_id = ?",
         (amount, user_id)
     )
-    conn.commit()
 
 
-def set_balance(user_id: int, amount: int):
-    cursor.execute(
+async def set_balance(user_id: int, amount: int):
+    await execute(
         "UPDATE users SET balance = ? WHERE user_id = ?",
         (amount, user_id)
     )
-    conn.commit()
 
 
-def deduct_balance(user_id: int, amount: int):
-    cursor.execute(
+async def deduct_balance(user_id: int, amount: int):
+    await execute(
         "UPDATE users SET balance = balance - ? WHERE user_id = ?",
         (amount, user_id)
     )
-    conn.commit()
 
 
-def get_users_count():
-    cursor.execute("SELECT COUNT(*) FROM users")
-    return cursor.fetchone()[0]
+async def get_counter(name: str):
+    row = await fetchone("SELECT value FROM counters WHERE name = ?", (name,))
+    return row[0] if row else 0
 
 
-def get_all_user_ids():
-    cursor.execute("SELECT user_id FROM users")
-    return [row[0] for row in cursor.fetchall()]
+async def get_users_count():
+    return await get_counter("users")
+
+
+async def get_all_user_ids():
+    rows = await fetchall("SELECT user_id FROM users")
+    return [row[0] for row in rows]
+
+
+async def get_user_ids_page(after_id: int = 0, limit: int = 500):
+    rows = await fetchall(
+        "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+        (after_id, limit)
+    )
+    return [row[0] for row in rows]
 
 
 # ================= PAYMENTS FUNCTIONS ================= #
 
-def add_payment(payment_id: str, user_id: int, amount: int, status: str):
-    cursor.execute(
+async def add_payment(payment_id: str, user_id: int, amount: int, status: str):
+    await execute(
         "INSERT INTO payments (payment_id, user_id, amount, status) VALUES (?, ?, ?, ?)",
         (payment_id, user_id, amount, status)
     )
-    conn.commit()
 
 
-def get_payments_stats():
+def _credit_payment(cursor, payment_id, user_id, amount, credit):
+    # повторная доставка того же платежа ничего не меняет
+    cursor.execute("""
+        INSERT INTO payments (payment_id, user_id, amount, status)
+        VALUES (?, ?, ?, 'success')
+        ON CONFLICT(payment_id) DO UPDATE SET status = 'success'
+        WHERE status IS NOT 'success'
+    """, (payment_id, user_id, amount))
+
+    if cursor.rowcount != 1:
+        return None
+
     cursor.execute(
-        "SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM payments WHERE status='success'"
+        "UPDATE users SET balance = balance + ? WHERE user_id = ?",
+        (credit, user_id)
     )
-    return cursor.fetchone()
+    return _balance(cursor, user_id)
+
+
+# запись платежа + зачисление в одной транзакции; None — платёж уже был учтён
+async def credit_payment(payment_id: str, user_id: int, amount: int, credit: int):
+    return await transaction(_credit_payment, payment_id, user_id, amount, credit)
+
+
+async def payment_exists(payment_id: str):
+    row = await fetchone(
+        "SELECT 1 FROM payments WHERE payment_id = ?",
+        (payment_id,)
+    )
+    return row is not None
+
+
+async def get_payments_stats():
+    rows = await fetchall(
+        "SELECT name, value FROM counters WHERE name IN ('payments_count', 'payments_sum')"
+    )
+    values = dict(rows)
+    return values.get("payments_count", 0), values.get("payments_sum", 0)
 
 
 # ================= GENERATION FUNCTIONS ================= #
 
-def add_generation(user_id: int, model: str):
+ADD_GENERATION_SQL = "INSERT INTO generations (user_id, model) VALUES (?, ?)"
+
+
+async def add_generation(user_id: int, model: str):
+    if write_behind is not None:
+        write_behind.add(ADD_GENERATION_SQL, (user_id, model))
+        return
+
+    await execute(ADD_GENERATION_SQL, (user_id, model))
+
+
+# ================= SETTLEMENT ================= #
+
+def _debit(cursor, user_id, amount):
+    # списываем только если хватает средств — баланс не уходит в минус
+    cursor.execute(
+        "UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?",
+        (amount, user_id, amount)
+    )
+    return cursor.rowcount == 1
+
+
+def _balance(cursor, user_id):
+    cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def _settle_generation(cursor, user_id, model, price):
+    if not _debit(cursor, user_id, price):
+        return None
+
     cursor.execute(
         "INSERT INTO generations (user_id, model) VALUES (?, ?)",
         (user_id, model)
     )
-    conn.commit()
+    return _balance(cursor, user_id)
 
 
-def get_generations_count():
-    cursor.execute("SELECT COUNT(*) FROM generations")
-    return cursor.fetchone()[0]
+def _reserve_balance(cursor, user_id, amount):
+    if not _debit(cursor, user_id, amount):
+        return None
 
+    return _balance(cursor, user_id)
 
-def get_top_users(limit=5):
-    cursor.execute("""
-        SELECT user_id, COUNT(*) as gen_count
-        FROM generations
-        GROUP BY user_id
-        ORDER BY gen_count DESC
+
+def _settle_reserved(cursor, user_id, model):
+    cursor.execute(
+        "INSERT INTO generations (user_id, model) VALUES (?, ?)",
+        (user_id, model)
+    )
+    return _balance(cursor, user_id)
+
+
+# списание + запись генерации + новый баланс; None — если не хватило средств
+async def settle_generation(user_id: int, model: str, price: int):
+    return await transaction(_settle_generation, user_id, model, price)
+
+
+# резерв при постановке в очередь; None — если не хватило средств
+async def reserve_balance(user_id: int, amount: int):
+    return await transaction(_reserve_balance, user_id, amount)
+
+
+# завершение зарезервированной генерации — деньги уже списаны
+async def settle_reserved(user_id: int, model: str):
+    if write_behind is not None:
+        await add_generation(user_id, model)
+        return (await fetchone("SELECT balance FROM users WHERE user_id = ?", (user_id,)))[0]
+
+    return await transaction(_settle_reserved, user_id, model)
+
+
+async def release_balance(user_id: int, amount: int):
+    await update_balance(user_id, amount)
+
+
+def _reserve_job(cursor, job_id, user_id, amount):
+    # резерв по задаче делается один раз: повторная доставка задачи
+    # только читает баланс
+    cursor.execute("SELECT 1 FROM job_payments WHERE job_id = ?", (job_id,))
+
+    if cursor.fetchone() is None:
+        if not _debit(cursor, user_id, amount):
+            return None
+
+        cursor.execute(
+            "INSERT INTO job_payments (job_id, user_id, amount, state) VALUES (?, ?, ?, 'reserved')",
+            (job_id, user_id, amount)
+        )
+
+    return _balance(cursor, user_id)
+
+
+def _job_state(cursor, job_id):
+    cursor.execute("SELECT state, amount FROM job_payments WHERE job_id = ?", (job_id,))
+    return cursor.fetchone()
+
+
+def _settle_job(cursor, job_id, user_id, model, reserved, price):
+    # reserved — резерв, сделанный при постановке в очередь (в job_payments
+    # его нет); резерв worker берётся из таблицы. Повторный settle ничего не меняет
+    row = _job_state(cursor, job_id)
+
+    if row is not None and row[0] != "reserved":
+        return _balance(cursor, user_id)
+
+    if row is not None:
+        cursor.execute("UPDATE job_payments SET state = 'settled' WHERE job_id = ?", (job_id,))
+        return _settle_reserved(cursor, user_id, model)
+
+    if reserved:
+        balance = _settle_reserved(cursor, user_id, model)
+    else:
+        balance = _settle_generation(cursor, user_id, model, price)
+
+        if balance is None:
+            return None
+
+    cursor.execute(
+        "INSERT INTO job_payments (job_id, user_id, amount, state) VALUES (?, ?, ?, 'settled')",
+        (job_id, user_id, reserved or price)
+    )
+    return balance
+
+
+# резерв, сделанный worker при выдаче задачи; None — если не хватило средств
+async def reserve_job(job_id: str, user_id: int, amount: int):
+    return await transaction(_reserve_job, job_id, user_id, amount)
+
+
+# списание по задаче очереди; None — если резерва не было и не хватило средств
+async def settle_job(job_id: str, user_id: int, model: str, reserved: int, price: int):
+    return await transaction(_settle_job, job_id, user_id, model, reserved, price)
+
+
+def _release_job(cursor, job_id, user_id, amount):
+    # первый release возвращает резерв: записанный в job_payments или
+    # переданный amount (резерв при постановке); повторный или после settle
+    # ничего не меняет
+    row = _job_state(cursor, job_id)
+
+    if row is None:
+        if not amount:
+            return False
+
+        cursor.execute(
+            "INSERT INTO job_payments (job_id, user_id, amount, state) VALUES (?, ?, ?, 'released')",
+            (job_id, user_id, amount)
+        )
+
+    elif row[0] == "reserved":
+        amount = row[1]
+        cursor.execute("UPDATE job_payments SET state = 'released' WHERE job_id = ?", (job_id,))
+
+    else:
+        return False
+
+    cursor.execute(
+        "UPDATE users SET balance = balance + ? WHERE user_id = ?",
+        (amount, user_id)
+    )
+    return True
+
+
+# возврат резерва задачи очереди; False — если уже возвращён
+async def release_job(job_id: str, user_id: int, amount: int):
+    return await transaction(_release_job, job_id, user_id, amount)
+
+
+async def get_generations_count():
+    return await get_counter("generations")
+
+
+async def get_user_generations_count(user_id: int):
+    row = await fetchone(
+        "SELECT generations FROM user_stats WHERE user_id = ?",
+        (user_id,)
+    )
+    return row[0] if row else 0
+
+
+async def get_user_paid_total(user_id: int):
+    row = await fetchone(
+        "SELECT paid_total FROM user_stats WHERE user_id = ?",
+        (user_id,)
+    )
+    return row[0] if row else 0
+
+
+async def get_top_users(limit=5):
+    return await fetchall("""
+        SELECT user_id, generations
+        FROM user_stats
+        ORDER BY generations DESC
         LIMIT ?
     """, (limit,))
-    return cursor.fetchall()
+
+
+# ================= USAGE EVENTS ================= #
+
+LOG_EVENT_SQL = "INSERT INTO usage_events (user_id, event) VALUES (?, ?)"
+
+
+async def log_event(user_id: int, event: str):
+    # при WRITE_BEHIND=1 события уходят пакетом, иначе — одной вставкой
+    if write_behind is not None:
+        write_behind.add(LOG_EVENT_SQL, (user_id, event))
+        return
+
+    await execute(LOG_EVENT_SQL, (user_id, event))
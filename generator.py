@@ -1,46 +1,267 @@
 import os
+import json
+import time
+import random
+import asyncio
 import aiohttp
 import logging
 import base64
 
+from concurrency import call, classify, OVERLOAD
+
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
 
+# ---------- Пул соединений ----------
+OPENROUTER_POOL_LIMIT = int(os.getenv("OPENROUTER_POOL_LIMIT", 100))
+OPENROUTER_POOL_LIMIT_PER_HOST = int(os.getenv("OPENROUTER_POOL_LIMIT_PER_HOST", 20))
+OPENROUTER_KEEPALIVE = float(os.getenv("OPENROUTER_KEEPALIVE", 60))
+OPENROUTER_DNS_TTL = int(os.getenv("OPENROUTER_DNS_TTL", 300))
 
-async def generate_image_openrouter(
-    prompt: str,
-    model: str,
-    format_value: str,
-    user_image: str = None,
-):
-    try:
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-        }
+# ---------- Таймауты по фазам ----------
+OPENROUTER_TIMEOUT_TOTAL = float(os.getenv("OPENROUTER_TIMEOUT_TOTAL", 120))
+OPENROUTER_TIMEOUT_CONNECT = float(os.getenv("OPENROUTER_TIMEOUT_CONNECT", 10))
+OPENROUTER_TIMEOUT_SOCK_READ = float(os.getenv("OPENROUTER_TIMEOUT_SOCK_READ", 90))
 
-        # ---------- Формируем content ----------
-        content = []
+# ---------- Повторы, circuit breaker, запасные модели ----------
+OPENROUTER_RETRIES = int(os.getenv("OPENROUTER_RETRIES", 2))
+OPENROUTER_BACKOFF_BASE = float(os.getenv("OPENROUTER_BACKOFF_BASE", 1))
+OPENROUTER_BACKOFF_MAX = float(os.getenv("OPENROUTER_BACKOFF_MAX", 20))
 
-        # Если есть изображение пользователя
-        if user_image:
-            # если вдруг передали bytes — конвертируем в base64
-            if isinstance(user_image, bytes):
-                user_image = base64.b64encode(user_image).decode()
+# общий бюджет времени на все попытки одной генерации
+OPENROUTER_DEADLINE = float(os.getenv("OPENROUTER_DEADLINE", 240))
 
-            content.append({
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/png;base64,{user_image}"
-                }
-            })
+# попытку или запасную модель не начинаем, если от бюджета осталось меньше
+OPENROUTER_MIN_ATTEMPT = float(os.getenv("OPENROUTER_MIN_ATTEMPT", 10))
+
+# через сколько секунд без ответа отправлять дублирующий запрос (0 — выключено)
+OPENROUTER_HEDGE_AFTER = float(os.getenv("OPENROUTER_HEDGE_AFTER", 0))
+
+CIRCUIT_FAILURES = int(os.getenv("OPENROUTER_CIRCUIT_FAILURES", 5))
+CIRCUIT_COOLDOWN = float(os.getenv("OPENROUTER_CIRCUIT_COOLDOWN", 30))
+
+# "модель=запасная1|запасная2,другая=запасная"
+OPENROUTER_FALLBACKS = {
+    model: fallbacks.split("|")
+    for model, fallbacks in (
+        item.split("=", 1) for item in os.getenv("OPENROUTER_FALLBACKS", "").split(",") if "=" in item
+    )
+}
+
+# сколько символов ответа OpenRouter попадает в лог
+OPENROUTER_LOG_LIMIT = int(os.getenv("OPENROUTER_LOG_LIMIT", 1000))
+
+# размер чанка при потоковом чтении ответа
+OPENROUTER_CHUNK_SIZE = 64 * 1024
+
+_session = None
+
+
+def _create_session():
+    connector = aiohttp.TCPConnector(
+        limit=OPENROUTER_POOL_LIMIT,
+        limit_per_host=OPENROUTER_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=OPENROUTER_KEEPALIVE,
+        ttl_dns_cache=OPENROUTER_DNS_TTL,
+        use_dns_cache=True,
+    )
+
+    timeout = aiohttp.ClientTimeout(
+        total=OPENROUTER_TIMEOUT_TOTAL,
+        connect=OPENROUTER_TIMEOUT_CONNECT,
+        sock_connect=OPENROUTER_TIMEOUT_CONNECT,
+        sock_read=OPENROUTER_TIMEOUT_SOCK_READ,
+    )
+
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+def _attempt_timeout(deadline):
+    # запрос не должен пережить общий бюджет генерации
+    return aiohttp.ClientTimeout(
+        total=max(min(OPENROUTER_TIMEOUT_TOTAL, deadline - time.monotonic()), 0),
+        connect=OPENROUTER_TIMEOUT_CONNECT,
+        sock_connect=OPENROUTER_TIMEOUT_CONNECT,
+        sock_read=OPENROUTER_TIMEOUT_SOCK_READ,
+    )
+
+
+async def init_session():
+    return get_session()
+
+
+def get_session():
+    global _session
+
+    # если on_startup ещё не отработал — создаём сессию лениво
+    if _session is None or _session.closed:
+        _session = _create_session()
+
+    return _session
+
+
+async def close_session():
+    global _session
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+    _session = None
+
+
+def _error_status(error, http_status):
+    # OpenRouter может вернуть ошибку апстрима с HTTP 200 — тогда код внутри тела
+    code = error.get("code") if isinstance(error, dict) else None
+    return code if isinstance(code, int) else http_status
+
+
+class _Truncated:
+
+    # форматируется только если запись лога действительно пишется
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        text = self.value if isinstance(self.value, str) else json.dumps(self.value, ensure_ascii=False)
+
+        if len(text) > OPENROUTER_LOG_LIMIT:
+            return f"{text[:OPENROUTER_LOG_LIMIT]}... ({len(text)} chars)"
+
+        return text
+
+
+_IMAGE_MARKER = b";base64,"
+_DATA_PREFIX = b'"data:image'
+
+
+class _ImageStream:
+
+    # Потоковый разбор ответа: base64 картинки декодируется в буфер по мере
+    # чтения, а остальной JSON копится без неё (url остаётся "data:image/...;base64,")
+    # и разбирается в конце. В памяти одна копия изображения вместо строки
+    # base64, dict из resp.json() и результата b64decode.
+
+    def __init__(self):
+        self.skeleton = bytearray()
+        self.image = None
+
+        self._in_image = False
+        self._keep = False
+        self._tail = b""
+        self._scan_from = 0
+
+    def feed(self, chunk):
+        while chunk:
+            chunk = self._feed_image(chunk) if self._in_image else self._feed_text(chunk)
+
+    def _feed_text(self, chunk):
+
+        self.skeleton += chunk
+
+        while True:
+            pos = self.skeleton.find(_IMAGE_MARKER, self._scan_from)
+
+            if pos == -1:
+                self._scan_from = max(0, len(self.skeleton) - len(_IMAGE_MARKER) + 1)
+                return b""
+
+            end = pos + len(_IMAGE_MARKER)
+            self._scan_from = end
+
+            # маркер должен быть внутри строки "data:image/...;base64,"
+            start = self.skeleton.rfind(b'"', 0, pos)
+
+            if self.skeleton.startswith(_DATA_PREFIX, start):
+                break
+
+        rest = bytes(self.skeleton[end:])
+        del self.skeleton[end:]
+
+        self._in_image = True
+        # декодируем только первую картинку, остальные пропускаем
+        self._keep = self.image is None
+
+        if self._keep:
+            self.image = bytearray()
+
+        return rest
+
+    def _feed_image(self, chunk):
+
+        end = chunk.find(b'"')
+        done = end != -1
+
+        data, rest = (chunk[:end], chunk[end:]) if done else (chunk, b"")
+
+        if not self._keep:
+            self._in_image = not done
+            return rest
+
+        data = self._tail + data
+        held = b""
+
+        # JSON-экранирование внутри base64 (\/, переносы строк);
+        # обрезанный на границе чанка обратный слэш ждёт следующего чанка
+        if b"\\" in data:
+            if not done and data.endswith(b"\\"):
+                data, held = data[:-1], data[-1:]
+
+            data = data.replace(b"\\/", b"/").replace(b"\\n", b"").replace(b"\\r", b"")
+
+        if done:
+            data += b"=" * (-len(data) % 4)
+            usable = len(data)
+        else:
+            usable = len(data) // 4 * 4
+
+        self.image += base64.b64decode(data[:usable])
+        self._tail = data[usable:] + held
+
+        self._in_image = not done
+
+        return rest
+
+    def finish(self):
+
+        if self._in_image:
+            raise ValueError("Truncated image in OpenRouter response")
+
+        return json.loads(self.skeleton)
+
+
+def _build_content(prompt, format_value, user_image):
+
+    content = []
+
+    # Если есть изображение пользователя
+    if user_image:
+        # если вдруг передали bytes — конвертируем в base64
+        if isinstance(user_image, bytes):
+            user_image = base64.b64encode(user_image).decode()
 
-        # Добавляем текст
         content.append({
-            "type": "text",
-            "text": f"{prompt}\n\nFormat: {format_value}"
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/png;base64,{user_image}"
+            }
         })
 
+    # Добавляем текст
+    content.append({
+        "type": "text",
+        "text": f"{prompt}\n\nFormat: {format_value}"
+    })
+
+    return content
+
+
+async def _request_image(model, content, deadline):
+    try:
+        headers = {
+            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+            "Content-Type": "application/json",
+        }
+
         # ---------- Payload ----------
         payload = {
             "model": model,
@@ -54,53 +275,244 @@ async def generate_image_openrouter(
         }
 
         # ---------- Запрос ----------
-        timeout = aiohttp.ClientTimeout(total=120)
+        session = get_session()
+
+        async with session.post(
+            OPENROUTER_URL,
+            headers=headers,
+            json=payload,
+            timeout=_attempt_timeout(deadline)
+        ) as resp:
+
+            # перегрузка / сбой апстрима — тело может быть не JSON
+            if resp.status == 429 or resp.status >= 500:
+                text = await resp.text()
+                logging.error("OpenRouter HTTP %s: %s", resp.status, _Truncated(text))
+                return {
+                    "error": f"HTTP {resp.status}",
+                    "status": resp.status,
+                    "retry_after": _retry_after(resp.headers.get("Retry-After")),
+                }
+
+            stream = _ImageStream()
+
+            async for chunk in resp.content.iter_chunked(OPENROUTER_CHUNK_SIZE):
+                stream.feed(chunk)
 
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.post(
-                OPENROUTER_URL,
-                headers=headers,
-                json=payload
-            ) as resp:
+            data = stream.finish()
+            logging.info("OpenRouter response: %s", _Truncated(data))
 
-                data = await resp.json()
-                logging.info(f"OpenRouter response: {data}")
+            # если API вернул ошибку
+            if "error" in data:
+                logging.error("OpenRouter error: %s", _Truncated(data))
+                return {"error": data["error"], "status": _error_status(data["error"], resp.status)}
 
-                # если API вернул ошибку
-                if "error" in data:
-                    logging.error(f"OpenRouter error: {data}")
-                    return {"error": data["error"]}
+            if "choices" not in data:
+                return {"error": f"Invalid response: {_Truncated(data)}", "status": resp.status}
 
-                if "choices" not in data:
-                    return {"error": f"Invalid response: {data}"}
+            message = data["choices"][0]["message"]
 
-                message = data["choices"][0]["message"]
+            if "images" not in message or not message["images"]:
+                return {"error": f"No images in response: {_Truncated(data)}"}
 
-                if "images" not in message or not message["images"]:
-                    return {"error": f"No images in response: {data}"}
+            image_obj = message["images"][0]
 
-                image_obj = message["images"][0]
+            # ---------- Получаем изображение ----------
+            if "image_url" in image_obj:
+                url = image_obj["image_url"]["url"]
 
-                # ---------- Получаем изображение ----------
-                if "image_url" in image_obj:
-                    url = image_obj["image_url"]["url"]
+                # base64 формат — уже декодирован при чтении ответа
+                if url.startswith("data:image"):
+                    image, stream.image = stream.image, None
+                    return {"image_bytes": bytes(image)}
 
-                    # base64 формат
-                    if url.startswith("data:image"):
-                        base64_data = url.split("base64,")[1]
-                        image_bytes = base64.b64decode(base64_data)
-                        return {"image_bytes": image_bytes}
+                # обычный URL
+                async with session.get(url, timeout=_attempt_timeout(deadline)) as img_resp:
+                    if img_resp.status != 200:
+                        return {"error": f"Image download failed: {img_resp.status}", "status": img_resp.status}
 
-                    # обычный URL
-                    async with session.get(url) as img_resp:
-                        if img_resp.status != 200:
-                            return {"error": f"Image download failed: {img_resp.status}"}
+                    image_bytes = await img_resp.read()
+                    return {"image_bytes": image_bytes}
 
-                        image_bytes = await img_resp.read()
-                        return {"image_bytes": image_bytes}
+            return {"error": "Unknown image format in response"}
 
-                return {"error": "Unknown image format in response"}
+    except asyncio.TimeoutError:
+        logging.exception("OpenRouter timeout")
+        return {"error": "timeout", "status": "timeout"}
+
+    except aiohttp.ClientError as e:
+        logging.exception("OpenRouter connection error")
+        return {"error": str(e), "status": "network"}
 
     except Exception as e:
         logging.exception("OpenRouter generation error")
         return {"error": str(e)}
+
+
+# ================= УСТОЙЧИВОСТЬ =================
+
+def _retry_after(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _retryable(result):
+    # повторять имеет смысл только перегрузку и сетевые сбои,
+    # ошибки модерации / формата запроса повтор не исправит
+    return classify(result) == OVERLOAD or result.get("status") == "network"
+
+
+def _backoff(attempt, retry_after=None):
+    # экспоненциальная задержка с полным джиттером, Retry-After важнее
+    if retry_after is not None:
+        return min(retry_after, OPENROUTER_BACKOFF_MAX)
+
+    return random.uniform(0, min(OPENROUTER_BACKOFF_MAX, OPENROUTER_BACKOFF_BASE * 2 ** attempt))
+
+
+class CircuitBreaker:
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self):
+
+        if self.opened_at is None:
+            return True
+
+        # после паузы пропускаем один пробный запрос
+        if not self.probing and time.monotonic() - self.opened_at >= CIRCUIT_COOLDOWN:
+            self.probing = True
+            return True
+
+        return False
+
+    def record(self, healthy):
+
+        if healthy:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+            return
+
+        self.failures += 1
+
+        if self.probing or self.failures >= CIRCUIT_FAILURES:
+            if self.opened_at is None or self.probing:
+                logging.warning(f"OpenRouter circuit opened after {self.failures} failures")
+
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+
+_breakers = {}
+
+
+def _breaker(model):
+
+    breaker = _breakers.get(model)
+
+    if breaker is None:
+        breaker = _breakers[model] = CircuitBreaker()
+
+    return breaker
+
+
+def circuit_states():
+    return {model: breaker.opened_at is not None for model, breaker in _breakers.items()}
+
+
+async def _attempt(model, content, deadline):
+
+    first = asyncio.create_task(call(model, _request_image, model, content, deadline))
+
+    if OPENROUTER_HEDGE_AFTER <= 0:
+        return await first
+
+    # хедж: если ответ задерживается, параллельно отправляем второй запрос
+    # и берём первый успешный (вторая генерация тоже оплачивается в OpenRouter)
+    pending = {first}
+    result = None
+
+    try:
+        done, pending = await asyncio.wait(pending, timeout=OPENROUTER_HEDGE_AFTER)
+
+        if done:
+            return first.result()
+
+        logging.warning(f"Hedging slow OpenRouter request for {model}")
+
+        pending.add(asyncio.create_task(call(model, _request_image, model, content, deadline)))
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                result = task.result()
+
+                if "image_bytes" in result:
+                    return result
+
+        return result
+
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def generate_image_openrouter(
+    prompt: str,
+    model: str,
+    format_value: str,
+    user_image: str = None,
+):
+
+    content = _build_content(prompt, format_value, user_image)
+    deadline = time.monotonic() + OPENROUTER_DEADLINE
+
+    result = {"error": "No models available"}
+
+    # основная модель, затем запасные из OPENROUTER_FALLBACKS
+    for candidate in [model] + OPENROUTER_FALLBACKS.get(model, []):
+
+        breaker = _breaker(candidate)
+
+        for attempt in range(OPENROUTER_RETRIES + 1):
+
+            if not breaker.allow():
+                result = {"error": f"Circuit open for {candidate}", "status": "circuit_open"}
+                break
+
+            if deadline - time.monotonic() < OPENROUTER_MIN_ATTEMPT:
+                break
+
+            result = await _attempt(candidate, content, deadline)
+
+            breaker.record(not _retryable(result))
+
+            if not _retryable(result):
+                if candidate != model and "image_bytes" in result:
+                    logging.warning(f"Generated with fallback model {candidate} instead of {model}")
+
+                return result
+
+            delay = _backoff(attempt, result.get("retry_after"))
+
+            if attempt == OPENROUTER_RETRIES or time.monotonic() + delay + OPENROUTER_MIN_ATTEMPT > deadline:
+                break
+
+            logging.warning(
+                f"OpenRouter {candidate} failed with {result.get('status')}, "
+                f"retry {attempt + 1} in {delay:.1f}s"
+            )
+
+            await asyncio.sleep(delay)
+
+        if deadline - time.monotonic() < OPENROUTER_MIN_ATTEMPT:
+            break
+
+    return result
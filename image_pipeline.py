@@ -0,0 +1,110 @@
+import os
+import time
+import asyncio
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from metrics import IMAGE_SECONDS
+
+# Пост-обработка результата генерации. Декодирование и пережатие
+# выполняются в пуле процессов, чтобы не блокировать event loop.
+
+RESULT_PROCESS_WORKERS = int(os.getenv("RESULT_PROCESS_WORKERS", 2))
+RESULT_JPEG_QUALITY = int(os.getenv("RESULT_JPEG_QUALITY", 90))
+RESULT_MAX_SIDE = int(os.getenv("RESULT_MAX_SIDE", 4096))
+
+# лимит Telegram для send_photo — 10 МБ
+RESULT_MAX_BYTES = int(os.getenv("RESULT_MAX_BYTES", 10 * 1024 * 1024))
+
+# форматы, которые отправляем как есть, без пережатия
+RESULT_PASSTHROUGH_FORMATS = os.getenv("RESULT_PASSTHROUGH_FORMATS", "JPEG,WEBP").split(",")
+
+_EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp"}
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+
+    if _executor is None:
+        # fork из процесса с event loop, потоками БД и открытыми сокетами
+        # копирует их состояние (и захваченные чужими потоками блокировки);
+        # forkserver порождает процессы из чистого сервера, где импортирован
+        # только этот модуль
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+
+        _executor = ProcessPoolExecutor(max_workers=RESULT_PROCESS_WORKERS, mp_context=context)
+
+    return _executor
+
+
+def _sniff(data: bytes):
+    if data[:3] == b"\xff\xd8\xff":
+        return "JPEG"
+
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "WEBP"
+
+    return None
+
+
+def _fits(data: bytes):
+    # Image.open читает только заголовок, пиксели не декодируются
+    with Image.open(BytesIO(data)) as image:
+        width, height = image.size
+
+    return max(width, height) <= RESULT_MAX_SIDE
+
+
+def _reencode(data: bytes, max_side: int, quality: int):
+    with Image.open(BytesIO(data)) as image:
+        image = image.convert("RGB")
+
+        if max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+
+    return buffer.getvalue()
+
+
+async def prepare_result(data: bytes):
+
+    started = time.perf_counter()
+    image_format = _sniff(data)
+
+    if (
+        image_format in RESULT_PASSTHROUGH_FORMATS
+        and len(data) <= RESULT_MAX_BYTES
+        and _fits(data)
+    ):
+        IMAGE_SECONDS.labels("passthrough").observe(time.perf_counter() - started)
+        return data, f"image.{_EXTENSIONS[image_format]}"
+
+    loop = asyncio.get_running_loop()
+
+    jpeg = await loop.run_in_executor(
+        _get_executor(),
+        _reencode,
+        data,
+        RESULT_MAX_SIDE,
+        RESULT_JPEG_QUALITY
+    )
+
+    IMAGE_SECONDS.labels("reencode").observe(time.perf_counter() - started)
+
+    return jpeg, "image.jpg"
+
+
+def shutdown_pipeline():
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
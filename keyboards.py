@@ -0,0 +1,53 @@
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from config import GENERATION_PRICE, CHANNEL_USERNAME
+
+
+# ================= UI =================
+
+def main_menu():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🎨 Сгенерировать изображение", callback_data="generate")],
+        [InlineKeyboardButton(text="👤 Личный кабинет", callback_data="profile")],
+        [InlineKeyboardButton(text="💰 Пополнить баланс", callback_data="topup")],
+        [InlineKeyboardButton(text="📢 TG канал", url=f"https://t.me/{CHANNEL_USERNAME}")],
+        [InlineKeyboardButton(text="ℹ️ О сервисе", callback_data="about")]
+    ])
+
+
+def model_menu():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"Nano Banana — {GENERATION_PRICE}₽", callback_data="model_nano")],
+        [InlineKeyboardButton(text=f"Nano Banana Pro — {GENERATION_PRICE}₽", callback_data="model_pro")],
+        [InlineKeyboardButton(text=f"SeeDream — {GENERATION_PRICE}₽", callback_data="model_seedream")],
+        [InlineKeyboardButton(text="⬅ Назад", callback_data="back_main")]
+    ])
+
+
+def mode_menu():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📝 Только текст", callback_data="mode_text")],
+        [InlineKeyboardButton(text="🖼 Фото + текст", callback_data="mode_image")],
+        [InlineKeyboardButton(text="⬅ Назад", callback_data="generate")]
+    ])
+
+
+def format_menu():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="1:1", callback_data="format_1_1"),
+            InlineKeyboardButton(text="16:9", callback_data="format_16_9"),
+        ],
+        [
+            InlineKeyboardButton(text="9:16", callback_data="format_9_16"),
+        ],
+        [InlineKeyboardButton(text="⬅ Назад", callback_data="generate")]
+    ])
+
+
+def after_generation_menu():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🎨 Сгенерировать изображение", callback_data="generate")],
+        [InlineKeyboardButton(text="🔁 Повторить", callback_data="generate")],
+        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_main")]
+    ])
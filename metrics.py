@@ -0,0 +1,234 @@
+import os
+import hmac
+import logging
+from bisect import bisect_left
+
+from aiohttp import web
+
+# Метрики в текстовом формате Prometheus без внешних зависимостей.
+# Наблюдение — поиск в dict по меткам и bisect по границам бакетов,
+# всё выполняется в event loop, поэтому без блокировок. Значения, которые
+# дешевле прочитать при скрейпе (глубина очереди, лимиты), собираются
+# коллекторами в момент запроса /metrics.
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+_registry = []
+_collectors = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+
+    kind = "untyped"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labels)
+        self._children = {}
+
+        _registry.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+
+        if child is None:
+            child = self._children[values] = self._child()
+
+        return child
+
+    def _samples(self):
+        for values, child in self._children.items():
+            yield from child.samples(self.name, _format_labels(self.labelnames, values), self.labelnames, values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class _Value:
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels, names, values):
+        yield f"{name}{labels} {self.value}"
+
+
+class Counter(_Metric):
+
+    kind = "counter"
+    _child = _Value
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+
+    kind = "gauge"
+    _child = _Value
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def clear(self):
+        self._children.clear()
+
+
+class _HistogramValue:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels, names, values):
+        total = 0
+
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            bucket_labels = _format_labels(names, values, f'le="{bound}"')
+            yield f"{name}_bucket{bucket_labels} {total}"
+
+        yield f"{name}_sum{labels} {self.sum}"
+        yield f"{name}_count{labels} {total}"
+
+
+class Histogram(_Metric):
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, description, labels)
+
+    def _child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+def register_collector(collector):
+    # collector — корутина без аргументов, обновляет Gauge перед отдачей метрик
+    _collectors.append(collector)
+
+
+async def render():
+
+    for collector in _collectors:
+        try:
+            await collector()
+        except Exception:
+            logging.exception("Metrics collector error")
+
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+# ================= МЕТРИКИ =================
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Update handling time by handler", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handler exceptions", ["handler"])
+UPDATE_PHASE_SECONDS = Counter(
+    "bot_update_phase_seconds_total",
+    "Update handling time split into db / net / other",
+    ["handler", "phase"]
+)
+
+QUEUE_DEPTH = Gauge("generation_queue_depth", "Generation jobs by stage", ["stage"])
+QUEUE_WAIT = Histogram("generation_queue_wait_seconds", "Time from enqueue to worker pickup", ["model"], SLOW_BUCKETS)
+GENERATIONS = Counter("generations_total", "Finished generation jobs", ["model", "result"])
+
+UPSTREAM_SECONDS = Histogram("openrouter_request_seconds", "OpenRouter request latency", ["model", "outcome"], SLOW_BUCKETS)
+UPSTREAM_ERRORS = Counter("openrouter_errors_total", "OpenRouter failed requests", ["model", "status"])
+UPSTREAM_LIMIT = Gauge("openrouter_concurrency_limit", "Adaptive concurrency limit", ["scope"])
+UPSTREAM_INFLIGHT = Gauge("openrouter_inflight", "Requests in progress", ["scope"])
+
+IMAGE_SECONDS = Histogram("image_prepare_seconds", "Result post-processing time", ["path"])
+
+DB_SECONDS = Histogram("db_query_seconds", "SQLite call latency including executor wait", ["op"])
+
+PAYMENT_WEBHOOKS = Counter("payment_webhook_total", "YooKassa webhook outcomes", ["outcome"])
+
+USER_CACHE = Counter("user_cache_lookups_total", "User profile cache lookups", ["result"])
+
+
+# ================= HTTP =================
+
+def _authorized(request):
+
+    # без METRICS_TOKEN публичный /metrics закрыт: метрики раскрывают
+    # нагрузку, имена моделей и ошибки
+    if not METRICS_TOKEN:
+        return False
+
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    return hmac.compare_digest(token, METRICS_TOKEN) or hmac.compare_digest(
+        request.query.get("token", ""), METRICS_TOKEN
+    )
+
+
+async def _metrics_response():
+    return web.Response(
+        body=(await render()).encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+
+async def metrics_handler(request):
+
+    # /metrics на публичном веб-сервере бота
+    if not METRICS_TOKEN:
+        return web.Response(text="not found", status=404)
+
+    if not _authorized(request):
+        return web.Response(text="forbidden", status=403)
+
+    return await _metrics_response()
+
+
+async def internal_metrics_handler(request):
+    # внутренний порт METRICS_PORT не публикуется наружу, токен не нужен
+    return await _metrics_response()
+
+
+async def start_metrics_server(port=METRICS_PORT):
+
+    # отдельный порт для скрейпа изнутри сети (worker.py, бот без токена)
+    app = web.Application()
+    app.router.add_get("/metrics", internal_metrics_handler)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+
+    return runner
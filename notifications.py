@@ -0,0 +1,69 @@
+import json
+import asyncio
+import logging
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+
+# Фоновая очередь уведомлений пользователям. Вебхуки кладут сообщение
+# в Redis и сразу отвечают, отправкой в Telegram занимается отдельная задача.
+
+NOTIFICATIONS_KEY = "notifications"
+
+# сколько раз повторять отправку при временных ошибках Telegram
+NOTIFICATION_MAX_ATTEMPTS = 5
+
+
+async def notify(redis, chat_id: int, text: str, parse_mode: str = "HTML"):
+    await redis.rpush(NOTIFICATIONS_KEY, json.dumps({
+        "chat_id": chat_id,
+        "text": text,
+        "parse_mode": parse_mode,
+    }))
+
+
+async def _retry(redis, message, error):
+
+    attempts = message.get("attempts", 0) + 1
+
+    if attempts >= NOTIFICATION_MAX_ATTEMPTS:
+        logging.error(f"Notification to {message['chat_id']} dropped after {attempts} attempts: {error}")
+        return
+
+    # возвращаем в начало очереди, чтобы не нарушить порядок сообщений
+    await redis.lpush(NOTIFICATIONS_KEY, json.dumps({**message, "attempts": attempts}))
+
+    delay = error.retry_after if isinstance(error, TelegramRetryAfter) else 2 ** attempts
+    logging.warning(f"Notification to {message['chat_id']} failed ({error}), retry in {delay}s")
+
+    # RetryAfter касается всего бота — ждём, прежде чем слать что-то ещё
+    await asyncio.sleep(delay)
+
+
+async def notification_worker(bot, redis):
+
+    while True:
+
+        try:
+
+            data = await redis.blpop(NOTIFICATIONS_KEY, timeout=5)
+
+            if data is None:
+                continue
+
+            message = json.loads(data[1])
+
+            try:
+                await bot.send_message(
+                    message["chat_id"],
+                    message["text"],
+                    parse_mode=message["parse_mode"]
+                )
+
+            except (TelegramRetryAfter, TelegramNetworkError, TelegramServerError) as e:
+                await _retry(redis, message, e)
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            logging.exception("Notification error")
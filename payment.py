@@ -1,14 +1,86 @@
-import uuid
 import os
-from yookassa import Configuration, Payment
+import uuid
+import json
+
+import aiohttp
+
+from timing import track
+
+YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
+YOOKASSA_SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY")
+YOOKASSA_API_URL = "https://api.yookassa.ru/v3/payments"
+
+# сколько повторные нажатия на ту же сумму возвращают уже созданный платёж
+PAYMENT_PENDING_TTL = int(os.getenv("PAYMENT_PENDING_TTL", 600))
+
+PAYMENT_TIMEOUT_TOTAL = float(os.getenv("PAYMENT_TIMEOUT_TOTAL", 30))
+PAYMENT_TIMEOUT_CONNECT = float(os.getenv("PAYMENT_TIMEOUT_CONNECT", 5))
+
+_session = None
+
+
+class PaymentError(Exception):
+    pass
+
+
+def _create_session():
+    connector = aiohttp.TCPConnector(
+        limit_per_host=10,
+        keepalive_timeout=60,
+        ttl_dns_cache=300,
+    )
+
+    timeout = aiohttp.ClientTimeout(
+        total=PAYMENT_TIMEOUT_TOTAL,
+        connect=PAYMENT_TIMEOUT_CONNECT,
+    )
+
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        auth=aiohttp.BasicAuth(str(YOOKASSA_SHOP_ID), str(YOOKASSA_SECRET_KEY)),
+    )
+
+
+def get_session():
+    global _session
+
+    if _session is None or _session.closed:
+        _session = _create_session()
+
+    return _session
 
-Configuration.account_id = os.getenv("YOOKASSA_SHOP_ID")
-Configuration.secret_key = os.getenv("YOOKASSA_SECRET_KEY")
 
+async def init_session():
+    return get_session()
 
-def create_payment(user_id: int, amount: int):
 
-    payment = Payment.create({
+async def close_session():
+    global _session
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+    _session = None
+
+
+async def create_payment(redis, user_id: int, amount: int):
+
+    pending_key = f"payment:pending:{user_id}:{amount}"
+    idempotence_key = f"payment:idempotence:{user_id}:{amount}"
+
+    # повторное нажатие — отдаём уже созданный платёж без запроса к API
+    cached = await redis.get(pending_key)
+
+    if cached is not None:
+        return json.loads(cached)
+
+    # параллельные нажатия получают один ключ идемпотентности,
+    # и YooKassa вернёт на них один и тот же платёж
+    await redis.set(idempotence_key, uuid.uuid4().hex, nx=True, ex=PAYMENT_PENDING_TTL)
+    key = (await redis.get(idempotence_key)).decode()
+
+    payload = {
         "amount": {
             "value": str(amount),
             "currency": "RUB"
@@ -18,13 +90,36 @@ def create_payment(user_id: int, amount: int):
             "return_url": "https://t.me/LuxRenderBot"
         },
         "capture": True,
-        "description": f"LuxRender balance topup",
+        "description": "LuxRender balance topup",
         "metadata": {
             "user_id": str(user_id)
         }
-    }, uuid.uuid4())
+    }
+
+    async with track("net"), get_session().post(
+        YOOKASSA_API_URL,
+        json=payload,
+        headers={"Idempotence-Key": key}
+    ) as resp:
+
+        data = await resp.json()
+
+        if resp.status != 200:
+            raise PaymentError(f"YooKassa error {resp.status}: {data}")
 
-    return {
-        "payment_id": payment.id,
-        "payment_url": payment.confirmation.confirmation_url
+    payment = {
+        "payment_id": data["id"],
+        "payment_url": data["confirmation"]["confirmation_url"]
     }
+
+    await redis.set(pending_key, json.dumps(payment), ex=PAYMENT_PENDING_TTL)
+
+    return payment
+
+
+async def forget_pending(redis, user_id: int, amount: int):
+    # платёж прошёл — следующее нажатие должно создать новый
+    await redis.delete(
+        f"payment:pending:{user_id}:{amount}",
+        f"payment:idempotence:{user_id}:{amount}"
+    )
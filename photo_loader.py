@@ -0,0 +1,79 @@
+import os
+from io import BytesIO
+from collections import OrderedDict
+
+from blob_store import put_blob, get_blob, BLOB_PREFIX, BLOB_TTL
+
+# Фото пользователя скачивается из Telegram только когда worker берёт задачу.
+# Порядок поиска: локальный LRU процесса -> общий blob store в Redis -> Telegram.
+
+PHOTO_CACHE_BYTES = int(os.getenv("PHOTO_CACHE_BYTES", 64 * 1024 * 1024))
+
+_cache = OrderedDict()
+_cache_size = 0
+
+
+def _cache_get(key):
+    data = _cache.get(key)
+
+    if data is not None:
+        _cache.move_to_end(key)
+
+    return data
+
+
+def _cache_put(key, data):
+    global _cache_size
+
+    if key in _cache or len(data) > PHOTO_CACHE_BYTES:
+        return
+
+    _cache[key] = data
+    _cache_size += len(data)
+
+    while _cache_size > PHOTO_CACHE_BYTES:
+        _, old = _cache.popitem(last=False)
+        _cache_size -= len(old)
+
+
+def photo_meta(photo):
+    return {
+        "file_id": photo.file_id,
+        "file_unique_id": photo.file_unique_id,
+        "width": photo.width,
+        "height": photo.height,
+        "file_size": photo.file_size,
+    }
+
+
+async def load_photo(bot, redis, photo):
+
+    # file_unique_id одинаков для одного и того же файла, в отличие от file_id
+    key = photo["file_unique_id"]
+    alias = f"{BLOB_PREFIX}tg:{key}"
+
+    data = _cache_get(key)
+
+    if data is not None:
+        return data
+
+    ref = await redis.get(alias)
+
+    if ref is not None:
+        data = await get_blob(redis, ref.decode())
+
+    if data is None:
+        file = await bot.get_file(photo["file_id"])
+
+        # download_file пишет чанки прямо в буфер
+        buffer = BytesIO()
+        await bot.download_file(file.file_path, destination=buffer)
+
+        data = buffer.getvalue()
+
+        ref = await put_blob(redis, data)
+        await redis.set(alias, ref, ex=BLOB_TTL)
+
+    _cache_put(key, data)
+
+    return data
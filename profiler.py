@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+from collections import Counter
+
+# Сэмплирующий профайлер живого процесса. Отдельный поток раз в
+# PROFILE_INTERVAL снимает стеки через sys._current_frames() и считает
+# одинаковые. Результат — folded stacks ("a;b;c 42" на строку), который
+# напрямую открывают flamegraph.pl, speedscope и inferno.
+
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", 120))
+
+_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _folded(frame):
+    stack = []
+
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+
+    return ";".join(reversed(stack))
+
+
+def sample(seconds, all_threads=False, interval=PROFILE_INTERVAL):
+
+    if not _lock.acquire(blocking=False):
+        raise ProfilerBusy("Profiler is already running")
+
+    try:
+        me = threading.get_ident()
+        main = threading.main_thread().ident
+        names = {}
+        counts = Counter()
+
+        deadline = time.monotonic() + min(seconds, PROFILE_MAX_SECONDS)
+
+        while time.monotonic() < deadline:
+
+            for ident, frame in sys._current_frames().items():
+
+                # по умолчанию только поток event loop
+                if ident == me or (not all_threads and ident != main):
+                    continue
+
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+                counts[f"{names.get(ident, ident)};{_folded(frame)}"] += 1
+
+            time.sleep(interval)
+
+        return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+    finally:
+        _lock.release()
+
+
+async def profile(seconds, all_threads=False):
+    loop = asyncio.get_running_loop()
+
+    # отдельный поток: event loop продолжает работать, пока его профилируют
+    return await loop.run_in_executor(None, sample, seconds, all_threads)
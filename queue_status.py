@@ -0,0 +1,232 @@
+import os
+import time
+import json
+import asyncio
+import logging
+
+from scheduler import waiting_order
+
+# Телеметрия очереди: время обработки по моделям, реальная позиция задачи
+# и ETA. Статус пользователю — одно сообщение, которое редактируется
+# не чаще STATUS_MIN_EDIT_INTERVAL и только если текст изменился.
+
+SERVICE_TIME_PREFIX = "gen:service_time:"
+SERVICE_TIME_SAMPLES = 200
+WORKERS_KEY = "gen:workers"
+STATUS_KEY = "gen:status"
+STATUS_LOCK_KEY = "gen:status:lock"
+
+# запись статуса обратно, только если worker ещё не забрал задачу
+# (job_started удаляет запись) — иначе она воскресла бы
+_UPDATE_STATUS = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+return -1
+"""
+
+STATUS_INTERVAL = float(os.getenv("STATUS_INTERVAL", 5))
+STATUS_MIN_EDIT_INTERVAL = float(os.getenv("STATUS_MIN_EDIT_INTERVAL", 15))
+STATUS_MAX_EDITS_PER_TICK = int(os.getenv("STATUS_MAX_EDITS_PER_TICK", 20))
+STATUS_SCAN_LIMIT = int(os.getenv("STATUS_SCAN_LIMIT", 1000))
+DEFAULT_SERVICE_TIME = float(os.getenv("DEFAULT_SERVICE_TIME", 20))
+
+# worker считается живым, если отмечался за последние N секунд
+WORKER_HEARTBEAT_TTL = 30
+WORKER_HEARTBEAT_INTERVAL = WORKER_HEARTBEAT_TTL / 3
+
+
+# ================= ИЗМЕРЕНИЯ =================
+
+async def record_service_time(redis, model, seconds):
+    key = SERVICE_TIME_PREFIX + model
+
+    pipe = redis.pipeline(transaction=False)
+    pipe.lpush(key, round(seconds, 3))
+    pipe.ltrim(key, 0, SERVICE_TIME_SAMPLES - 1)
+    await pipe.execute()
+
+
+async def heartbeat(redis, consumer):
+    await redis.zadd(WORKERS_KEY, {consumer: time.time()})
+
+
+async def service_times(redis, models):
+    models = list(models)
+
+    pipe = redis.pipeline(transaction=False)
+
+    for model in models:
+        pipe.lrange(SERVICE_TIME_PREFIX + model, 0, -1)
+
+    result = {}
+
+    for model, samples in zip(models, await pipe.execute()):
+        values = sorted(float(v) for v in samples)
+        # медиана по скользящему окну последних замеров
+        result[model] = values[len(values) // 2] if values else DEFAULT_SERVICE_TIME
+
+    return result
+
+
+async def active_workers(redis):
+    now = time.time()
+
+    pipe = redis.pipeline(transaction=False)
+    pipe.zremrangebyscore(WORKERS_KEY, 0, now - WORKER_HEARTBEAT_TTL)
+    pipe.zcard(WORKERS_KEY)
+    _, count = await pipe.execute()
+
+    return max(count, 1)
+
+
+# ================= ПОЗИЦИЯ И ETA =================
+
+def estimate(jobs, index, times, workers):
+    # сумма времени обработки задач впереди и своей, делённая на число worker
+    total = sum(times.get(model, DEFAULT_SERVICE_TIME) for _, model in jobs[:index + 1])
+    return index + 1, total / workers
+
+
+def status_text(position, eta):
+    minutes, seconds = divmod(int(eta), 60)
+    eta_text = f"{minutes} мин {seconds} сек" if minutes else f"{seconds} сек"
+
+    return (
+        f"⏳ Запрос в очереди\n"
+        f"Ваша позиция: {position}\n"
+        f"Примерное ожидание: ~{eta_text}"
+    )
+
+
+# ================= СООБЩЕНИЕ СО СТАТУСОМ =================
+
+async def register(redis, job_id, chat_id, message_id, text):
+    # позицию и ETA подставит status_updater на ближайшем тике
+    await redis.hset(STATUS_KEY, job_id, json.dumps({
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "text": text,
+        "edited_at": 0,
+    }))
+
+
+async def job_started(bot, redis, task):
+
+    job_id = task.get("job_id")
+
+    if not job_id:
+        return None
+
+    pipe = redis.pipeline(transaction=True)
+    pipe.hget(STATUS_KEY, job_id)
+    pipe.hdel(STATUS_KEY, job_id)
+    raw, _ = await pipe.execute()
+
+    if raw is None:
+        return None
+
+    message_id = json.loads(raw)["message_id"]
+
+    try:
+        await bot.edit_message_text(
+            "🎨 Генерирую изображение...",
+            chat_id=task["chat_id"],
+            message_id=message_id
+        )
+    except Exception:
+        pass
+
+    return message_id
+
+
+async def job_finished(bot, chat_id, message_id):
+    if message_id:
+        try:
+            await bot.delete_message(chat_id, message_id)
+        except Exception:
+            pass
+
+
+async def _update_statuses(bot, redis):
+
+    # при нескольких репликах статусы обновляет только одна за тик
+    if not await redis.set(STATUS_LOCK_KEY, 1, nx=True, px=int(STATUS_INTERVAL * 1000)):
+        return
+
+    statuses = await redis.hgetall(STATUS_KEY)
+
+    if not statuses:
+        return
+
+    jobs = await waiting_order(redis, STATUS_SCAN_LIMIT)
+    times = await service_times(redis, {model for _, model in jobs})
+    workers = await active_workers(redis)
+
+    index = {job_id: i for i, (job_id, _) in enumerate(jobs)}
+    truncated = len(jobs) >= STATUS_SCAN_LIMIT
+    now = time.time()
+    edits = 0
+
+    for job_id, raw in statuses.items():
+
+        job_id = job_id.decode()
+        status = json.loads(raw)
+
+        if job_id not in index:
+            if truncated:
+                continue
+
+            # задачу забрали раньше, чем статус был зарегистрирован:
+            # worker о сообщении не знает, поэтому убираем его сами
+            if await redis.hdel(STATUS_KEY, job_id):
+                await job_finished(bot, status["chat_id"], status["message_id"])
+
+            continue
+
+        if now - status["edited_at"] < STATUS_MIN_EDIT_INTERVAL:
+            continue
+
+        text = status_text(*estimate(jobs, index[job_id], times, workers))
+
+        if text == status["text"]:
+            continue
+
+        # укладываемся в лимиты Telegram на редактирование
+        if edits >= STATUS_MAX_EDITS_PER_TICK:
+            break
+
+        # задачу могли забрать после hgetall — её сообщение уже у worker
+        if not await redis.hexists(STATUS_KEY, job_id):
+            continue
+
+        try:
+            await bot.edit_message_text(
+                text,
+                chat_id=status["chat_id"],
+                message_id=status["message_id"]
+            )
+        except Exception:
+            logging.debug("Status edit failed", exc_info=True)
+
+        edits += 1
+
+        status["text"] = text
+        status["edited_at"] = now
+        await redis.eval(_UPDATE_STATUS, 1, STATUS_KEY, job_id, json.dumps(status))
+
+
+async def status_updater(bot, redis):
+
+    while True:
+
+        try:
+            await _update_statuses(bot, redis)
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            logging.exception("Queue status updater error")
+
+        await asyncio.sleep(STATUS_INTERVAL)
@@ -0,0 +1,125 @@
+import os
+import logging
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message, CallbackQuery
+
+# Token bucket в Redis. Все ведра (пользователь + глобальное) проверяются
+# и списываются одним Lua-скриптом за один round trip; время берётся
+# у Redis, поэтому лимит общий для всех реплик.
+
+RATE_LIMIT_PREFIX = "ratelimit:"
+
+_TOKEN_BUCKET = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+
+local buckets = {}
+local retry = 0
+
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local burst = tonumber(ARGV[i * 2])
+    local data = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(data[1]) or burst
+    local ts = tonumber(data[2]) or now
+
+    tokens = math.min(burst, tokens + (now - ts) / 1000 * rate)
+
+    if tokens < 1 then
+        retry = math.max(retry, math.ceil((1 - tokens) / rate * 1000))
+    end
+
+    buckets[i] = tokens
+end
+
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local burst = tonumber(ARGV[i * 2])
+    local tokens = buckets[i]
+
+    if retry == 0 then
+        tokens = tokens - 1
+    end
+
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+end
+
+return retry
+"""
+
+
+def _limit(name, default):
+    # формат: "токенов_в_секунду,размер_ведра", например "0.066,2"
+    raw = os.getenv(f"RATE_LIMIT_{name.upper()}")
+
+    if not raw:
+        return default
+
+    rate, burst = raw.split(",")
+    return float(rate), int(burst)
+
+
+# scope -> (лимит на пользователя, глобальный лимит или None)
+RATE_LIMITS = {
+    "default": (_limit("default_user", (2, 10)), None),
+    "generation": (_limit("generation_user", (1 / 15, 2)), _limit("generation_global", (20, 40))),
+    "payment": (_limit("payment_user", (0.2, 3)), _limit("payment_global", (10, 20))),
+}
+
+
+class RateLimiter:
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.script = redis.register_script(_TOKEN_BUCKET)
+
+    # 0 — запрос разрешён, иначе сколько миллисекунд подождать
+    async def hit(self, scope, user_id):
+
+        user_limit, global_limit = RATE_LIMITS[scope]
+
+        keys = [f"{RATE_LIMIT_PREFIX}{scope}:{user_id}"]
+        args = list(user_limit)
+
+        if global_limit:
+            keys.append(f"{RATE_LIMIT_PREFIX}{scope}:global")
+            args.extend(global_limit)
+
+        return int(await self.script(keys=keys, args=args))
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+
+    def __init__(self, redis):
+        self.limiter = RateLimiter(redis)
+
+    async def __call__(self, handler, event, data):
+
+        scope = get_flag(data, "rate_limit", default="default")
+        user = data.get("event_from_user")
+
+        if user is None:
+            return await handler(event, data)
+
+        try:
+            retry_ms = await self.limiter.hit(scope, user.id)
+        except Exception:
+            # если Redis недоступен — не блокируем пользователей
+            logging.exception("Rate limiter error")
+            return await handler(event, data)
+
+        if not retry_ms:
+            return await handler(event, data)
+
+        wait = max(1, round(retry_ms / 1000))
+
+        if isinstance(event, CallbackQuery):
+            await event.answer(f"⏳ Слишком часто. Подождите {wait} сек.")
+
+        elif isinstance(event, Message) and scope != "default":
+            await event.answer(f"⏳ Слишком часто. Подождите {wait} сек.")
+
+        return None
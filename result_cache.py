@@ -0,0 +1,67 @@
+import os
+import time
+import hashlib
+
+# Кеш готовых результатов: одинаковый промпт + модель + формат + исходное фото
+# отдаются повторно по file_id уже отправленной в Telegram картинки.
+
+RESULT_CACHE_PREFIX = "gencache:"
+RESULT_CACHE_INDEX_KEY = "gencache:index"
+
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 86400))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 10000))
+
+# модели, для которых допустимо повторно отдавать один и тот же результат;
+# по умолчанию кеш выключен — каждая генерация уникальна
+RESULT_CACHE_MODELS = set(filter(None, os.getenv("RESULT_CACHE_MODELS", "").split(",")))
+
+
+def cache_enabled(model: str):
+    return model in RESULT_CACHE_MODELS
+
+
+def normalize_prompt(prompt: str):
+    return " ".join((prompt or "").split()).casefold()
+
+
+def image_key(photo):
+    # file_unique_id один и тот же для одного и того же файла
+    return photo["file_unique_id"] if photo else ""
+
+
+def cache_key(prompt: str, model: str, format_value: str, image: str = ""):
+    raw = "\x00".join([normalize_prompt(prompt), model, format_value, image])
+    return RESULT_CACHE_PREFIX + hashlib.sha256(raw.encode()).hexdigest()
+
+
+async def lookup(redis, key: str):
+
+    file_id = await redis.get(key)
+
+    if file_id is None:
+        return None
+
+    # обновляем время последнего обращения для вытеснения
+    await redis.zadd(RESULT_CACHE_INDEX_KEY, {key: time.time()})
+
+    return file_id.decode()
+
+
+async def store(redis, key: str, file_id: str):
+
+    pipe = redis.pipeline(transaction=False)
+    pipe.set(key, file_id, ex=RESULT_CACHE_TTL)
+    pipe.zadd(RESULT_CACHE_INDEX_KEY, {key: time.time()})
+    pipe.zcard(RESULT_CACHE_INDEX_KEY)
+    *_, size = await pipe.execute()
+
+    overflow = size - RESULT_CACHE_MAX_ENTRIES
+
+    if overflow <= 0:
+        return
+
+    # вытесняем самые давно использованные записи
+    evicted = await redis.zpopmin(RESULT_CACHE_INDEX_KEY, overflow)
+
+    if evicted:
+        await redis.delete(*[member for member, _ in evicted])
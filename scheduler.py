@@ -0,0 +1,353 @@
+import os
+import json
+import uuid
+from collections import deque
+
+from task_queue import (
+    GENERATION_STREAM_KEY,
+    GENERATION_GROUP,
+    INFLIGHT_KEY,
+    BLOCK_MS,
+    reclaim,
+    read,
+)
+
+# Справедливый планировщик очереди генераций.
+#
+# Новые задачи не попадают в стрим сразу: они ждут в списке пользователя
+# внутри своей полосы (lane). Когда есть свободный worker, Lua-скрипт
+# выбирает полосу по весам, внутри полосы — следующего пользователя по кругу
+# (с учётом лимита задач в работе на пользователя) и переносит одну его
+# задачу в стрим. Всё состояние в Redis, поэтому расписание общее для
+# всех процессов worker.
+#
+# Ключи полос и пользователей _DISPATCH строит сам (пользователь выбирается
+# внутри скрипта), а не получает в KEYS — это работает только на одиночном
+# Redis или с репликами, но не в Redis Cluster.
+
+LANE_PREFIX = "gen:lane:"
+IDLE_KEY = "gen:idle"
+TICK_KEY = "gen:lane:tick"
+
+# сколько задач одного пользователя может быть в работе одновременно
+USER_INFLIGHT_CAP = int(os.getenv("USER_INFLIGHT_CAP", 2))
+
+# веса полос: на 3 задачи приоритетной полосы приходится 1 обычная
+LANE_WEIGHTS = [
+    (name, int(weight))
+    for name, weight in (
+        item.split(":") for item in os.getenv("LANE_WEIGHTS", "priority:3,default:1").split(",")
+    )
+]
+
+# в приоритетную полосу попадают пользователи, пополнившие баланс на эту сумму,
+# и быстрые модели из PRIORITY_MODELS; без PRIORITY_LANE в LANE_WEIGHTS
+# (например, LANE_WEIGHTS=default:1) все задачи идут в DEFAULT_LANE
+PRIORITY_LANE = os.getenv("PRIORITY_LANE", "priority")
+DEFAULT_LANE = os.getenv("DEFAULT_LANE", "default")
+PRIORITY_PAID_MIN = int(os.getenv("PRIORITY_PAID_MIN", 500))
+PRIORITY_MODELS = set(filter(None, os.getenv("PRIORITY_MODELS", "").split(",")))
+
+_LANES = {name for name, _ in LANE_WEIGHTS}
+
+# задача в полосе, которой нет в LANE_WEIGHTS, никогда не будет выдана
+if DEFAULT_LANE not in _LANES:
+    raise ValueError(f"DEFAULT_LANE {DEFAULT_LANE!r} is missing from LANE_WEIGHTS")
+
+if len(_LANES) != len(LANE_WEIGHTS) or any(weight <= 0 for _, weight in LANE_WEIGHTS):
+    raise ValueError("LANE_WEIGHTS must list unique lanes with positive weights")
+
+_SCHEDULE = """
+redis.call('RPUSH', KEYS[1], ARGV[2])
+redis.call('INCR', KEYS[4])
+
+if redis.call('SADD', KEYS[3], ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[2], ARGV[1])
+end
+
+return redis.call('LLEN', KEYS[1])
+"""
+
+_DISPATCH = """
+local stream, idle_key, inflight_key, tick_key = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local group, consumer, idle_window = ARGV[1], ARGV[2], tonumber(ARGV[3])
+local cap, prefix = tonumber(ARGV[4]), ARGV[5]
+local lanes = cjson.decode(ARGV[6])
+
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+
+if consumer ~= '' then
+    redis.call('ZADD', idle_key, now, consumer)
+end
+
+redis.call('ZREMRANGEBYSCORE', idle_key, 0, now - idle_window)
+local idle = redis.call('ZCARD', idle_key)
+
+-- задачи в стриме, ещё не выданные ни одному worker
+local pending = redis.call('XPENDING', stream, group)[1]
+local ready = redis.call('XLEN', stream) - tonumber(pending)
+
+local total_weight = 0
+for _, lane in ipairs(lanes) do
+    total_weight = total_weight + lane[2]
+end
+
+local moved = 0
+
+while ready < idle do
+    local slot = redis.call('INCR', tick_key) % total_weight
+    local start = 1
+
+    for i, lane in ipairs(lanes) do
+        if slot < lane[2] then
+            start = i
+            break
+        end
+        slot = slot - lane[2]
+    end
+
+    local job = nil
+
+    for offset = 0, #lanes - 1 do
+        local lane = lanes[((start - 1 + offset) % #lanes) + 1][1]
+        local ring = prefix .. lane .. ':ring'
+        local members = prefix .. lane .. ':members'
+
+        for _ = 1, redis.call('LLEN', ring) do
+            local uid = redis.call('LMOVE', ring, ring, 'LEFT', 'RIGHT')
+            local user_key = prefix .. lane .. ':user:' .. uid
+            local inflight = tonumber(redis.call('HGET', inflight_key, uid) or '0')
+
+            if inflight < cap then
+                job = redis.call('LPOP', user_key)
+
+                if job then
+                    redis.call('DECR', prefix .. lane .. ':size')
+                end
+
+                if redis.call('LLEN', user_key) == 0 then
+                    redis.call('LREM', ring, 0, uid)
+                    redis.call('SREM', members, uid)
+                end
+
+                if job then
+                    redis.call('HINCRBY', inflight_key, uid, 1)
+                    break
+                end
+            end
+        end
+
+        if job then
+            break
+        end
+    end
+
+    if not job then
+        break
+    end
+
+    redis.call('XADD', stream, '*', 'task', job)
+    ready = ready + 1
+    moved = moved + 1
+end
+
+return moved
+"""
+
+
+def _lane_key(lane, suffix):
+    return f"{LANE_PREFIX}{lane}:{suffix}"
+
+
+def choose_lane(model, paid_total):
+    if PRIORITY_LANE in _LANES and (model in PRIORITY_MODELS or paid_total >= PRIORITY_PAID_MIN):
+        return PRIORITY_LANE
+
+    return DEFAULT_LANE
+
+
+async def submit(redis, task, lane=DEFAULT_LANE):
+
+    task["job_id"] = uuid.uuid4().hex
+    task["lane"] = lane
+    task["scheduled"] = True
+
+    user_id = str(task["user_id"])
+
+    await redis.eval(
+        _SCHEDULE,
+        4,
+        _lane_key(lane, f"user:{user_id}"),
+        _lane_key(lane, "ring"),
+        _lane_key(lane, "members"),
+        _lane_key(lane, "size"),
+        user_id,
+        json.dumps(task)
+    )
+
+    return task["job_id"]
+
+
+async def dispatch(redis, consumer=""):
+
+    # consumer — worker, который сейчас встанет на чтение стрима;
+    # без него (из webhook) только переносим задачи для уже ждущих worker
+    return await redis.eval(
+        _DISPATCH,
+        4,
+        GENERATION_STREAM_KEY,
+        IDLE_KEY,
+        INFLIGHT_KEY,
+        TICK_KEY,
+        GENERATION_GROUP,
+        consumer,
+        BLOCK_MS + 5000,
+        USER_INFLIGHT_CAP,
+        LANE_PREFIX,
+        json.dumps(LANE_WEIGHTS)
+    )
+
+
+async def fetch(redis, consumer, block_ms=BLOCK_MS):
+
+    reclaimed = await reclaim(redis, consumer)
+
+    if reclaimed:
+        return reclaimed
+
+    await dispatch(redis, consumer)
+
+    try:
+        return await read(redis, consumer, block_ms)
+    finally:
+        await redis.zrem(IDLE_KEY, consumer)
+
+
+async def queue_depth(redis):
+
+    pipe = redis.pipeline(transaction=False)
+
+    for lane, _ in LANE_WEIGHTS:
+        pipe.get(_lane_key(lane, "size"))
+
+    pipe.xlen(GENERATION_STREAM_KEY)
+    pipe.xpending(GENERATION_STREAM_KEY, GENERATION_GROUP)
+
+    *sizes, length, pending = await pipe.execute()
+
+    # задачи, поставленные до появления счётчика, в нём не учтены
+    depth = {f"lane_{lane}": max(int(size or 0), 0) for (lane, _), size in zip(LANE_WEIGHTS, sizes)}
+    depth["ready"] = length - pending["pending"]
+    depth["running"] = pending["pending"]
+
+    return depth
+
+
+# ================= ПОРЯДОК ОЖИДАНИЯ =================
+
+async def waiting_order(redis, limit, job_id=None):
+
+    # первые limit задач в порядке выдачи worker; с job_id — до этой задачи.
+    # Читаем только то, что может попасть в первые limit позиций, пачками
+    # через pipeline
+
+    # 1. задачи, уже перенесённые в стрим, но не выданные worker
+    groups = await redis.xinfo_groups(GENERATION_STREAM_KEY)
+    last_delivered = "0-0"
+
+    for group in groups:
+        if group["name"].decode() == GENERATION_GROUP:
+            last_delivered = group["last-delivered-id"].decode()
+
+    entries = await redis.xrange(GENERATION_STREAM_KEY, min=f"({last_delivered}", max="+", count=limit)
+
+    order = []
+
+    for msg_id, fields in entries:
+        task = json.loads(fields[b"task"])
+        order.append((task.get("job_id", msg_id), task["model"]))
+
+        if job_id is not None and task.get("job_id") == job_id:
+            return order
+
+    remaining = limit - len(order)
+
+    if remaining <= 0:
+        return order
+
+    # 2. очереди пользователей по полосам — повторяем выбор Lua-скрипта
+    # (лимит задач в работе не учитываем, это оценка). За remaining выборов
+    # полоса успевает дойти не дальше remaining-го пользователя в круге
+    pipe = redis.pipeline(transaction=False)
+
+    for lane, _ in LANE_WEIGHTS:
+        pipe.lrange(_lane_key(lane, "ring"), 0, remaining - 1)
+
+    pipe.get(TICK_KEY)
+
+    *lane_users, tick = await pipe.execute()
+
+    # у каждого пользователя сначала читаем его долю позиций, остальное — по требованию
+    users = []
+    pipe = redis.pipeline(transaction=False)
+
+    for (lane, _), uids in zip(LANE_WEIGHTS, lane_users):
+        chunk = -(-remaining // len(uids)) if uids else 0
+
+        for uid in uids:
+            key = _lane_key(lane, f"user:{uid.decode()}")
+            users.append({"lane": lane, "key": key, "chunk": chunk, "fetched": chunk})
+            pipe.llen(key)
+            pipe.lrange(key, 0, chunk - 1)
+
+    replies = await pipe.execute()
+    rings = {lane: deque() for lane, _ in LANE_WEIGHTS}
+
+    for user, length, jobs in zip(users, replies[::2], replies[1::2]):
+        if jobs:
+            user["length"] = length
+            user["jobs"] = deque(jobs)
+            rings[user["lane"]].append(user)
+
+    tick = int(tick or 0)
+    total_weight = sum(weight for _, weight in LANE_WEIGHTS)
+
+    while len(order) < limit and any(rings.values()):
+        tick += 1
+        slot = tick % total_weight
+        start = 0
+
+        for i, (_, weight) in enumerate(LANE_WEIGHTS):
+            if slot < weight:
+                start = i
+                break
+            slot -= weight
+
+        for offset in range(len(LANE_WEIGHTS)):
+            lane = LANE_WEIGHTS[(start + offset) % len(LANE_WEIGHTS)][0]
+            ring = rings[lane]
+
+            if not ring:
+                continue
+
+            user = ring.popleft()
+            task = json.loads(user["jobs"].popleft())
+
+            if not user["jobs"] and user["fetched"] < user["length"]:
+                user["jobs"].extend(await redis.lrange(
+                    user["key"], user["fetched"], user["fetched"] + user["chunk"] - 1
+                ))
+                user["fetched"] += user["chunk"]
+
+            if user["jobs"]:
+                ring.append(user)
+
+            order.append((task["job_id"], task["model"]))
+
+            if job_id is not None and task["job_id"] == job_id:
+                return order
+
+            break
+
+    return order
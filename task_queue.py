@@ -0,0 +1,256 @@
+import os
+import json
+import logging
+
+from redis.exceptions import ResponseError
+
+# Очередь генераций на Redis Streams с группой потребителей.
+# Задача удаляется из стрима только после ack, поэтому рестарт
+# или зависший worker не теряют оплаченную работу.
+
+GENERATION_STREAM_KEY = "generation_stream"
+GENERATION_GROUP = "generation_workers"
+DEAD_LETTER_KEY = "generation_dead"
+LEGACY_QUEUE_KEY = "generation_queue"
+
+# сколько задач каждого пользователя сейчас в стриме или в работе (см. scheduler.py)
+INFLIGHT_KEY = "gen:inflight"
+
+# сколько задача может провисеть у потребителя без ack, прежде чем её заберёт другой
+VISIBILITY_TIMEOUT = int(os.getenv("QUEUE_VISIBILITY_TIMEOUT", 300))
+MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", 3))
+BLOCK_MS = int(os.getenv("QUEUE_BLOCK_MS", 5000))
+
+# отметки о выполненных шагах задачи: при повторной доставке worker
+# не отправляет картинку и не списывает деньги второй раз
+PROGRESS_PREFIX = "gen:progress:"
+PROGRESS_TTL = VISIBILITY_TIMEOUT * (MAX_ATTEMPTS + 1)
+
+
+# потребитель с именем по pid после рестарта больше не появится; пустых
+# и давно молчащих удаляем, чтобы XINFO и метрики не росли бесконечно
+CONSUMER_IDLE_TIMEOUT = int(os.getenv("QUEUE_CONSUMER_IDLE_TIMEOUT", 3600))
+
+# LPOP и XADD в одном скрипте: падение посередине не теряет задачу
+_MIGRATE_LEGACY = """
+local moved = 0
+while true do
+    local raw = redis.call('LPOP', KEYS[1])
+    if not raw then
+        return moved
+    end
+    redis.call('XADD', KEYS[2], '*', 'task', raw)
+    moved = moved + 1
+end
+"""
+
+# проверка pending и удаление атомарны: DELCONSUMER выбрасывает pending
+# потребителя, и задача, выданная ему между проверкой и удалением, потерялась бы
+_PRUNE_CONSUMERS = """
+local removed = 0
+for _, consumer in ipairs(redis.call('XINFO', 'CONSUMERS', KEYS[1], ARGV[1])) do
+    local info = {}
+    for i = 1, #consumer, 2 do
+        info[consumer[i]] = consumer[i + 1]
+    end
+    if tonumber(info['pending']) == 0 and tonumber(info['idle']) > tonumber(ARGV[2]) then
+        redis.call('XGROUP', 'DELCONSUMER', KEYS[1], ARGV[1], info['name'])
+        removed = removed + 1
+    end
+end
+return removed
+"""
+
+
+async def init_queue(redis):
+
+    try:
+        await redis.xgroup_create(
+            GENERATION_STREAM_KEY,
+            GENERATION_GROUP,
+            id="0",
+            mkstream=True
+        )
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+    # переносим задачи, оставшиеся в старой очереди на списке
+    migrated = await redis.eval(_MIGRATE_LEGACY, 2, LEGACY_QUEUE_KEY, GENERATION_STREAM_KEY)
+
+    if migrated:
+        logging.warning(f"Migrated {migrated} legacy generation tasks to stream")
+
+    removed = await redis.eval(
+        _PRUNE_CONSUMERS, 1, GENERATION_STREAM_KEY,
+        GENERATION_GROUP, CONSUMER_IDLE_TIMEOUT * 1000
+    )
+
+    if removed:
+        logging.warning(f"Removed {removed} idle stream consumers")
+
+
+async def enqueue(redis, task):
+    return await redis.xadd(GENERATION_STREAM_KEY, {"task": json.dumps(task)})
+
+
+async def queue_size(redis):
+    return await redis.xlen(GENERATION_STREAM_KEY)
+
+
+def _decode(message):
+    msg_id, fields = message
+    return msg_id, json.loads(fields[b"task"])
+
+
+async def _attempts(redis, msg_id):
+    pending = await redis.xpending_range(
+        GENERATION_STREAM_KEY,
+        GENERATION_GROUP,
+        min=msg_id,
+        max=msg_id,
+        count=1
+    )
+
+    if not pending:
+        return 1
+
+    return pending[0]["times_delivered"]
+
+
+async def reclaim(redis, consumer):
+
+    response = await redis.xautoclaim(
+        GENERATION_STREAM_KEY,
+        GENERATION_GROUP,
+        consumer,
+        min_idle_time=VISIBILITY_TIMEOUT * 1000,
+        start_id="0-0",
+        count=1
+    )
+
+    for message in response[1]:
+        # запись могла быть удалена из стрима — тогда просто подтверждаем её
+        if message is None or message[1] is None:
+            continue
+
+        msg_id, task = _decode(message)
+        attempts = await _attempts(redis, msg_id)
+
+        logging.warning(f"Reclaimed stalled generation {msg_id} (attempt {attempts})")
+
+        return msg_id, task, attempts
+
+    for msg_id in response[2] if len(response) > 2 else []:
+        await redis.xack(GENERATION_STREAM_KEY, GENERATION_GROUP, msg_id)
+
+    return None
+
+
+async def read(redis, consumer, block_ms=BLOCK_MS):
+
+    response = await redis.xreadgroup(
+        GENERATION_GROUP,
+        consumer,
+        {GENERATION_STREAM_KEY: ">"},
+        count=1,
+        block=block_ms
+    )
+
+    if not response:
+        return None
+
+    _, messages = response[0]
+
+    if not messages:
+        return None
+
+    msg_id, task = _decode(messages[0])
+
+    return msg_id, task, 1
+
+
+async def fetch(redis, consumer, block_ms=BLOCK_MS):
+
+    # сначала забираем задачи, зависшие у упавших потребителей
+    reclaimed = await reclaim(redis, consumer)
+
+    if reclaimed:
+        return reclaimed
+
+    return await read(redis, consumer, block_ms)
+
+
+def _progress_key(msg_id):
+    return PROGRESS_PREFIX + (msg_id.decode() if isinstance(msg_id, bytes) else msg_id)
+
+
+async def get_progress(redis, msg_id):
+    raw = await redis.hgetall(_progress_key(msg_id))
+    return {field.decode(): value.decode() for field, value in raw.items()}
+
+
+async def mark_progress(redis, msg_id, **fields):
+    key = _progress_key(msg_id)
+
+    pipe = redis.pipeline(transaction=True)
+    pipe.hset(key, mapping=fields)
+    pipe.expire(key, PROGRESS_TTL)
+    await pipe.execute()
+
+
+async def touch(redis, consumer, msg_id):
+    # XCLAIM на себя сбрасывает время простоя записи, не увеличивая счётчик
+    # доставок: долгая генерация не уходит другому worker по таймауту видимости
+    await redis.xclaim(
+        GENERATION_STREAM_KEY,
+        GENERATION_GROUP,
+        consumer,
+        min_idle_time=0,
+        message_ids=[msg_id],
+        justid=True
+    )
+
+
+# поле удаляется, когда задач в работе не осталось, иначе хэш растёт
+# на каждого пользователя, хоть раз ставившего генерацию
+_RELEASE_INFLIGHT = """
+if redis.call('HINCRBY', KEYS[1], ARGV[1], -1) <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+end
+"""
+
+
+def _release_inflight(pipe, task):
+    if task and task.get("scheduled"):
+        pipe.eval(_RELEASE_INFLIGHT, 1, INFLIGHT_KEY, task["user_id"])
+
+
+async def ack(redis, msg_id, task=None):
+
+    pipe = redis.pipeline(transaction=True)
+    pipe.xack(GENERATION_STREAM_KEY, GENERATION_GROUP, msg_id)
+    pipe.xdel(GENERATION_STREAM_KEY, msg_id)
+    pipe.delete(_progress_key(msg_id))
+    _release_inflight(pipe, task)
+    await pipe.execute()
+
+
+async def dead_letter(redis, msg_id, task, attempts, reason=""):
+
+    record = {
+        "id": msg_id.decode() if isinstance(msg_id, bytes) else msg_id,
+        "task": task,
+        "attempts": attempts,
+        "reason": reason,
+    }
+
+    pipe = redis.pipeline(transaction=True)
+    pipe.rpush(DEAD_LETTER_KEY, json.dumps(record))
+    pipe.xack(GENERATION_STREAM_KEY, GENERATION_GROUP, msg_id)
+    pipe.xdel(GENERATION_STREAM_KEY, msg_id)
+    pipe.delete(_progress_key(msg_id))
+    _release_inflight(pipe, task)
+    await pipe.execute()
+
+    logging.error(f"Generation {record['id']} moved to dead-letter after {attempts} attempts")
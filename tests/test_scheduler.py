@@ -0,0 +1,119 @@
+# pip install -r requirements-dev.txt && python -m pytest tests
+
+import json
+import random
+import asyncio
+from collections import deque
+
+import fakeredis.aioredis
+
+import scheduler
+import task_queue
+
+
+# полная симуляция порядка выдачи — так waiting_order работал до ограничения
+# по limit; ограниченная версия должна давать тот же префикс
+async def _full_order(redis):
+
+    groups = await redis.xinfo_groups(task_queue.GENERATION_STREAM_KEY)
+    last_delivered = "0-0"
+
+    for group in groups:
+        if group["name"].decode() == task_queue.GENERATION_GROUP:
+            last_delivered = group["last-delivered-id"].decode()
+
+    entries = await redis.xrange(task_queue.GENERATION_STREAM_KEY, min=f"({last_delivered}", max="+")
+    order = [(json.loads(fields[b"task"])["job_id"], json.loads(fields[b"task"])["model"]) for _, fields in entries]
+
+    rings = {}
+
+    for lane, _ in scheduler.LANE_WEIGHTS:
+        ring = deque()
+
+        for uid in await redis.lrange(scheduler._lane_key(lane, "ring"), 0, -1):
+            jobs = await redis.lrange(scheduler._lane_key(lane, f"user:{uid.decode()}"), 0, -1)
+
+            if jobs:
+                ring.append(deque(json.loads(job) for job in jobs))
+
+        rings[lane] = ring
+
+    tick = int(await redis.get(scheduler.TICK_KEY) or 0)
+    total_weight = sum(weight for _, weight in scheduler.LANE_WEIGHTS)
+
+    while any(rings.values()):
+        tick += 1
+        slot = tick % total_weight
+        start = 0
+
+        for i, (_, weight) in enumerate(scheduler.LANE_WEIGHTS):
+            if slot < weight:
+                start = i
+                break
+            slot -= weight
+
+        for offset in range(len(scheduler.LANE_WEIGHTS)):
+            ring = rings[scheduler.LANE_WEIGHTS[(start + offset) % len(scheduler.LANE_WEIGHTS)][0]]
+
+            if not ring:
+                continue
+
+            jobs = ring.popleft()
+            task = jobs.popleft()
+
+            if jobs:
+                ring.append(jobs)
+
+            order.append((task["job_id"], task["model"]))
+            break
+
+    return order
+
+
+async def _random_queue(rng):
+
+    redis = fakeredis.aioredis.FakeRedis()
+    await task_queue.init_queue(redis)
+
+    users = rng.choice([[1, 2], list(range(1, 9))])
+    lanes = [lane for lane, _ in scheduler.LANE_WEIGHTS]
+
+    for _ in range(rng.randint(0, 120)):
+        task = {"user_id": rng.choice(users), "model": f"m{rng.randint(1, 3)}"}
+        await scheduler.submit(redis, task, rng.choice(lanes))
+
+    # часть задач уже перенесена в стрим для ждущего worker
+    if rng.random() < 0.5:
+        await scheduler.dispatch(redis, "worker-1")
+
+    return redis
+
+
+def test_waiting_order_matches_full_simulation():
+
+    async def run():
+        rng = random.Random(7)
+
+        for _ in range(40):
+            redis = await _random_queue(rng)
+            full = await _full_order(redis)
+
+            for limit in (1, 5, 17, 50, 1000):
+                assert await scheduler.waiting_order(redis, limit) == full[:limit]
+
+            if full:
+                job_id = rng.choice(full)[0]
+                index = [waiting_id for waiting_id, _ in full].index(job_id)
+
+                assert await scheduler.waiting_order(redis, 1000, job_id) == full[:index + 1]
+
+    asyncio.run(run())
+
+
+def test_choose_lane_falls_back_when_priority_lane_is_disabled(monkeypatch):
+
+    assert scheduler.choose_lane("model", scheduler.PRIORITY_PAID_MIN) == scheduler.PRIORITY_LANE
+
+    monkeypatch.setattr(scheduler, "_LANES", {scheduler.DEFAULT_LANE})
+
+    assert scheduler.choose_lane("model", scheduler.PRIORITY_PAID_MIN) == scheduler.DEFAULT_LANE
@@ -0,0 +1,109 @@
+import os
+import time
+import logging
+from contextvars import ContextVar
+from contextlib import asynccontextmanager
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+from metrics import HANDLER_SECONDS, HANDLER_ERRORS, UPDATE_PHASE_SECONDS
+
+# Разбивка времени обработки апдейта: БД, сеть (Bot API, HTTP-клиенты)
+# и остальное (CPU, Redis, ожидание event loop). Счётчики лежат в
+# ContextVar, поэтому database._run и сетевые вызовы добавляют время
+# в апдейт, внутри которого выполняются.
+
+SLOW_UPDATE_THRESHOLD = float(os.getenv("SLOW_UPDATE_THRESHOLD", 1.0))
+
+_breakdown = ContextVar("update_breakdown", default=None)
+
+
+def add(phase, seconds):
+    breakdown = _breakdown.get()
+
+    if breakdown is not None:
+        breakdown[phase] += seconds
+
+
+def set_handler(name):
+    breakdown = _breakdown.get()
+
+    if breakdown is not None:
+        breakdown["handler"] = name
+
+
+@asynccontextmanager
+async def track(phase):
+    started = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        add(phase, time.perf_counter() - started)
+
+
+class TimingMiddleware(BaseMiddleware):
+
+    # outer middleware на dp.update: видит апдейт целиком, имя хендлера
+    # подставляет внутренний MetricsMiddleware
+    async def __call__(self, handler, event, data):
+
+        breakdown = {"handler": "unhandled", "db": 0.0, "net": 0.0}
+        token = _breakdown.set(breakdown)
+        started = time.perf_counter()
+
+        try:
+            return await handler(event, data)
+
+        finally:
+            total = time.perf_counter() - started
+            _breakdown.reset(token)
+
+            name = breakdown["handler"]
+            other = max(total - breakdown["db"] - breakdown["net"], 0.0)
+
+            UPDATE_PHASE_SECONDS.labels(name, "db").inc(breakdown["db"])
+            UPDATE_PHASE_SECONDS.labels(name, "net").inc(breakdown["net"])
+            UPDATE_PHASE_SECONDS.labels(name, "other").inc(other)
+
+            if total >= SLOW_UPDATE_THRESHOLD:
+                logging.warning(
+                    "Slow update %s (%s): %.3fs = db %.3fs + net %.3fs + other %.3fs",
+                    event.update_id,
+                    name,
+                    total,
+                    breakdown["db"],
+                    breakdown["net"],
+                    other
+                )
+
+
+class MetricsMiddleware(BaseMiddleware):
+
+    # внутренний middleware на message / callback_query: здесь уже известен хендлер
+    async def __call__(self, handler, event, data):
+
+        callback = data.get("handler")
+        name = callback.callback.__name__ if callback is not None else "unhandled"
+
+        set_handler(name)
+        started = time.perf_counter()
+
+        try:
+            return await handler(event, data)
+
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+
+        finally:
+            HANDLER_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+
+class RequestTimingMiddleware(BaseRequestMiddleware):
+
+    # middleware сессии Bot: время запросов к Bot API идёт в «net»
+    async def __call__(self, make_request, bot, method):
+        async with track("net"):
+            return await make_request(bot, method)
@@ -0,0 +1,280 @@
+import os
+import time
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+
+import database
+from metrics import USER_CACHE
+
+# Кеш профилей пользователей поверх database.py.
+# L1 — LRU в памяти процесса с коротким TTL, L2 (опционально) — Redis.
+# Любая запись через этот модуль инвалидирует оба уровня и рассылает
+# инвалидацию остальным процессам. Решения о деньгах принимаются только
+# по данным из БД (fresh=True или условные списания в database.py).
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 10))
+USER_CACHE_REDIS = os.getenv("USER_CACHE_REDIS", "0") == "1"
+USER_CACHE_REDIS_TTL = int(os.getenv("USER_CACHE_REDIS_TTL", 300))
+
+USER_CACHE_PREFIX = "usercache:"
+USER_CACHE_VERSION_PREFIX = "usercache:ver:"
+USER_CACHE_CHANNEL = "usercache:invalidate"
+
+# L2 заполняется, только если с момента чтения версии инвалидаций не было:
+# иначе строка, прочитанная из БД до записи, перетёрла бы свежие данные
+_FILL = """
+if (redis.call('GET', KEYS[2]) or '') == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+end
+"""
+
+_cache = OrderedDict()
+_redis = None
+
+# чтения из БД в процессе: user_id -> множество токенов. Инвалидация
+# очищает множество, и такое чтение уже не попадает в L1
+_loading = {}
+
+stats = {"hits": 0, "redis_hits": 0, "misses": 0}
+
+
+def configure(redis):
+    global _redis
+
+    if USER_CACHE_REDIS:
+        _redis = redis
+
+
+def cache_stats():
+    total = stats["hits"] + stats["redis_hits"] + stats["misses"]
+    hit_rate = (stats["hits"] + stats["redis_hits"]) / total if total else 0.0
+
+    return {**stats, "size": len(_cache), "hit_rate": hit_rate}
+
+
+async def collect_metrics():
+    for result in ("hits", "redis_hits", "misses"):
+        USER_CACHE.labels(result).set(stats[result])
+
+
+def _local_get(user_id):
+    entry = _cache.get(user_id)
+
+    if entry is None:
+        return None
+
+    expires, row = entry
+
+    if expires < time.monotonic():
+        _cache.pop(user_id, None)
+        return None
+
+    _cache.move_to_end(user_id)
+    return row
+
+
+def _local_put(user_id, row):
+    _cache[user_id] = (time.monotonic() + USER_CACHE_TTL, row)
+    _cache.move_to_end(user_id)
+
+    while len(_cache) > USER_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+async def _load(user_id, version):
+
+    token = object()
+    _loading.setdefault(user_id, set()).add(token)
+
+    try:
+        row = await database.get_user(user_id)
+    finally:
+        loading = _loading.get(user_id)
+        current = loading is not None and token in loading
+
+        if current:
+            loading.discard(token)
+
+        if loading is not None and not loading:
+            del _loading[user_id]
+
+    if row is None:
+        return None
+
+    # пока шло чтение, пользователя инвалидировали — строка могла устареть
+    if current:
+        _local_put(user_id, row)
+
+    if _redis is not None:
+        await _redis.eval(
+            _FILL,
+            2,
+            f"{USER_CACHE_PREFIX}{user_id}",
+            f"{USER_CACHE_VERSION_PREFIX}{user_id}",
+            version or b"",
+            json.dumps(row),
+            USER_CACHE_REDIS_TTL
+        )
+
+    return row
+
+
+async def get_user(user_id: int, fresh: bool = False):
+
+    version = None
+
+    if not fresh:
+        row = _local_get(user_id)
+
+        if row is not None:
+            stats["hits"] += 1
+            return row
+
+        if _redis is not None:
+            pipe = _redis.pipeline(transaction=False)
+            pipe.get(f"{USER_CACHE_PREFIX}{user_id}")
+            pipe.get(f"{USER_CACHE_VERSION_PREFIX}{user_id}")
+            raw, version = await pipe.execute()
+
+            if raw is not None:
+                row = tuple(json.loads(raw))
+                stats["redis_hits"] += 1
+                _local_put(user_id, row)
+                return row
+
+        stats["misses"] += 1
+
+    elif _redis is not None:
+        version = await _redis.get(f"{USER_CACHE_VERSION_PREFIX}{user_id}")
+
+    return await _load(user_id, version)
+
+
+def _drop_local(user_id):
+    _cache.pop(user_id, None)
+
+    if user_id in _loading:
+        _loading[user_id].clear()
+
+
+async def invalidate(user_id: int):
+
+    _drop_local(user_id)
+
+    if _redis is not None:
+        version_key = f"{USER_CACHE_VERSION_PREFIX}{user_id}"
+
+        pipe = _redis.pipeline(transaction=False)
+        pipe.delete(f"{USER_CACHE_PREFIX}{user_id}")
+        pipe.incr(version_key)
+        pipe.expire(version_key, USER_CACHE_REDIS_TTL)
+        pipe.publish(USER_CACHE_CHANNEL, str(user_id))
+        await pipe.execute()
+
+
+async def listen_invalidations():
+
+    if _redis is None:
+        return
+
+    pubsub = _redis.pubsub()
+    await pubsub.subscribe(USER_CACHE_CHANNEL)
+
+    try:
+        while True:
+            try:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=5)
+
+                if message:
+                    _drop_local(int(message["data"]))
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                logging.exception("User cache invalidation listener error")
+                await asyncio.sleep(1)
+    finally:
+        await pubsub.aclose()
+
+
+# ================= ЗАПИСЬ С ИНВАЛИДАЦИЕЙ ================= #
+
+async def add_user(user_id: int):
+    await database.add_user(user_id)
+    await invalidate(user_id)
+
+
+async def update_model(user_id: int, model: str):
+    await database.update_model(user_id, model)
+    await invalidate(user_id)
+
+
+async def update_format(user_id: int, format_value: str):
+    await database.update_format(user_id, format_value)
+    await invalidate(user_id)
+
+
+async def update_balance(user_id: int, amount: int):
+    await database.update_balance(user_id, amount)
+    await invalidate(user_id)
+
+
+async def set_balance(user_id: int, amount: int):
+    await database.set_balance(user_id, amount)
+    await invalidate(user_id)
+
+
+async def deduct_balance(user_id: int, amount: int):
+    await database.deduct_balance(user_id, amount)
+    await invalidate(user_id)
+
+
+async def settle_generation(user_id: int, model: str, price: int):
+    balance = await database.settle_generation(user_id, model, price)
+    await invalidate(user_id)
+    return balance
+
+
+async def reserve_balance(user_id: int, amount: int):
+    balance = await database.reserve_balance(user_id, amount)
+    await invalidate(user_id)
+    return balance
+
+
+async def settle_reserved(user_id: int, model: str):
+    balance = await database.settle_reserved(user_id, model)
+    await invalidate(user_id)
+    return balance
+
+
+async def release_balance(user_id: int, amount: int):
+    await database.release_balance(user_id, amount)
+    await invalidate(user_id)
+
+
+async def reserve_job(job_id: str, user_id: int, amount: int):
+    balance = await database.reserve_job(job_id, user_id, amount)
+    await invalidate(user_id)
+    return balance
+
+
+async def settle_job(job_id: str, user_id: int, model: str, reserved: int, price: int):
+    balance = await database.settle_job(job_id, user_id, model, reserved, price)
+    await invalidate(user_id)
+    return balance
+
+
+async def release_job(job_id: str, user_id: int, amount: int):
+    released = await database.release_job(job_id, user_id, amount)
+    await invalidate(user_id)
+    return released
+
+
+async def credit_payment(payment_id: str, user_id: int, amount: int, credit: int):
+    balance = await database.credit_payment(payment_id, user_id, amount, credit)
+    await invalidate(user_id)
+    return balance
@@ -0,0 +1,491 @@
+import os
+import socket
+import sqlite3
+import time
+import signal
+import asyncio
+import logging
+import aiohttp
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import BufferedInputFile
+from redis.asyncio import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+
+from config import TOKEN, REDIS_URL, TELEGRAM_API_URL, GENERATION_PRICE, WORKER_CONCURRENCY
+from database import log_event, close_db
+from user_cache import (
+    get_user,
+    settle_generation,
+    settle_reserved,
+    reserve_job,
+    settle_job,
+    release_balance,
+    release_job,
+    configure as configure_user_cache,
+    listen_invalidations,
+    collect_metrics as collect_cache_metrics,
+)
+from generator import generate_image_openrouter, init_session, close_session
+from keyboards import after_generation_menu
+from task_queue import (
+    init_queue,
+    ack,
+    dead_letter,
+    touch,
+    get_progress,
+    mark_progress,
+    MAX_ATTEMPTS,
+)
+from scheduler import fetch
+from blob_store import get_blob
+from photo_loader import load_photo
+from image_pipeline import prepare_result, shutdown_pipeline
+from queue_status import (
+    job_started,
+    job_finished,
+    record_service_time,
+    heartbeat,
+    WORKER_HEARTBEAT_INTERVAL,
+)
+from result_cache import cache_enabled, cache_key, image_key, lookup, store
+from concurrency import (
+    configure as configure_limits,
+    upstream,
+    collect_metrics as collect_limit_metrics,
+)
+from metrics import QUEUE_WAIT, GENERATIONS, METRICS_PORT, register_collector, start_metrics_server
+
+# сколько ждать завершения текущих задач при остановке
+WORKER_SHUTDOWN_TIMEOUT = int(os.getenv("WORKER_SHUTDOWN_TIMEOUT", 60))
+
+_stop_event = None
+_tasks = []
+
+
+# ================= WORKER =================
+
+FAILED_TEXT = "❌ Ошибка генерации.\nПопробуйте снова."
+
+# после этих ошибок задачу оставляем без ack и повторяем: сеть, Redis,
+# перегрузка Telegram, занятая БД. Остальные (битое изображение, бот
+# заблокирован, неверный запрос) повтор не исправит — задачу завершаем сразу
+TRANSIENT_ERRORS = (
+    TelegramNetworkError,
+    TelegramServerError,
+    TelegramRetryAfter,
+    RedisConnectionError,
+    RedisTimeoutError,
+    aiohttp.ClientError,
+    asyncio.TimeoutError,
+    sqlite3.OperationalError,
+)
+
+
+async def settle(user_id, model, reserved=0, job_ref=None):
+
+    # списание, запись генерации и новый баланс — одна транзакция;
+    # по задаче очереди — через job_payments, повторно не списывается
+    if job_ref:
+        new_balance = await settle_job(job_ref, user_id, model, reserved, GENERATION_PRICE)
+    elif reserved:
+        new_balance = await settle_reserved(user_id, model)
+    else:
+        new_balance = await settle_generation(user_id, model, GENERATION_PRICE)
+
+    if new_balance is None:
+        logging.warning(f"Generation for {user_id} delivered without enough balance")
+        new_balance = (await get_user(user_id, fresh=True))[0]
+
+    return new_balance
+
+
+async def notify_done(bot, chat_id, new_balance):
+    await bot.send_message(
+        chat_id,
+        f"✅ Готово!\n💎 Остаток: {new_balance}₽",
+        reply_markup=after_generation_menu()
+    )
+
+
+async def finish_generation(bot, chat_id, user_id, model, reserved=0):
+    await notify_done(bot, chat_id, await settle(user_id, model, reserved))
+
+
+async def deliver_cached(bot, redis, chat_id, user_id, model, key, reserved=0):
+
+    # reserved — стоимость, уже списанная вызывающим; если картинку
+    # отдать не удалось, возвращаем её
+    try:
+        file_id = await lookup(redis, key)
+
+        if file_id is not None:
+            await bot.send_photo(chat_id, file_id)
+
+    except Exception:
+        if reserved:
+            await release_balance(user_id, reserved)
+        raise
+
+    if file_id is None:
+        return False
+
+    await finish_generation(bot, chat_id, user_id, model, reserved)
+
+    return True
+
+
+async def _mark(redis, msg_id, progress, **fields):
+    progress.update(fields)
+    await mark_progress(redis, msg_id, **fields)
+
+
+def _status_message(progress):
+    return int(progress.get("status_message_id", 0)) or None
+
+
+def _job_ref(msg_id, task):
+    # ключ задачи в job_payments: job_id планировщика, для старых задач — id в стриме
+    return task.get("job_id") or (msg_id.decode() if isinstance(msg_id, bytes) else msg_id)
+
+
+def _reserved(task, progress):
+    # при BALANCE_RESERVE=0 резерв делает сам worker и хранит его в отметках
+    return task.get("reserved") or int(progress.get("reserved", 0))
+
+
+async def fail_generation(bot, redis, msg_id, task, progress, text=FAILED_TEXT):
+
+    # генерация не состоялась — возвращаем зарезервированные деньги.
+    # Возврат привязан к задаче в БД, поэтому повтор после сбоя
+    # до отметки failed второй раз деньги не вернёт
+    if "failed" not in progress:
+        # резерв worker, не успевший попасть в отметки, найдётся в job_payments
+        await release_job(_job_ref(msg_id, task), task["user_id"], _reserved(task, progress))
+
+        await _mark(redis, msg_id, progress, failed="1")
+
+        await log_event(task["user_id"], "generation_failed")
+        GENERATIONS.labels(task["model"], "failed").inc()
+
+    try:
+        await bot.send_message(
+            task["chat_id"],
+            text,
+            reply_markup=after_generation_menu()
+        )
+    except (TelegramBadRequest, TelegramForbiddenError):
+        logging.warning(f"Failure notice for {task['user_id']} not delivered", exc_info=True)
+
+
+async def deliver_result(bot, redis, msg_id, task, progress, status_message_id):
+
+    # возвращает "ok" / "cached", когда картинка у пользователя,
+    # None — если генерация не удалась и пользователь уже уведомлён
+    chat_id = task["chat_id"]
+    prompt = task["prompt"]
+    model = task["model"]
+    format_value = task["format"]
+
+    key = None
+
+    # такой же запрос мог выполниться, пока задача стояла в очереди
+    # (старые задачи с base64 / image_ref в кеш не попадают)
+    if cache_enabled(model) and not task.get("image") and not task.get("image_ref"):
+        key = cache_key(prompt, model, format_value, image_key(task.get("photo")))
+        file_id = await lookup(redis, key)
+
+        if file_id is not None:
+            await bot.send_photo(chat_id, file_id)
+            await _mark(redis, msg_id, progress, delivered="cached")
+            return "cached"
+
+    # старые задачи ещё могут содержать base64 или ссылку на blob
+    user_image = task.get("image")
+
+    if task.get("photo"):
+        user_image = await load_photo(bot, redis, task["photo"])
+
+    elif task.get("image_ref"):
+        user_image = await get_blob(redis, task["image_ref"])
+
+        if user_image is None:
+            await job_finished(bot, chat_id, status_message_id)
+            await fail_generation(bot, redis, msg_id, task, progress, "❌ Изображение устарело.\nОтправьте его заново.")
+            return None
+
+    result = await generate_image_openrouter(
+        prompt=prompt,
+        model=model,
+        format_value=format_value,
+        user_image=user_image
+    )
+
+    if not result or "image_bytes" not in result:
+        await job_finished(bot, chat_id, status_message_id)
+        await fail_generation(bot, redis, msg_id, task, progress)
+        return None
+
+    image_bytes, filename = await prepare_result(result["image_bytes"])
+
+    file = BufferedInputFile(image_bytes, filename=filename)
+
+    sent = await bot.send_photo(chat_id, file)
+
+    # отметку ставим сразу: дальше повтор задачи не должен слать картинку снова
+    await _mark(redis, msg_id, progress, delivered="ok")
+
+    if key:
+        await store(redis, key, sent.photo[-1].file_id)
+
+    return "ok"
+
+
+async def complete_generation(bot, redis, msg_id, task, progress):
+
+    if "settled" in progress:
+        new_balance = progress["settled"]
+    else:
+        new_balance = await settle(task["user_id"], task["model"], _reserved(task, progress), _job_ref(msg_id, task))
+        await _mark(redis, msg_id, progress, settled=str(new_balance))
+
+    await notify_done(bot, task["chat_id"], new_balance)
+
+
+async def process_job(bot, redis, msg_id, task):
+
+    started = time.monotonic()
+
+    if task.get("enqueued_at"):
+        QUEUE_WAIT.labels(task["model"]).observe(time.time() - task["enqueued_at"])
+
+    # отметки прошлых попыток: картинка уже могла уйти, а деньги — списаться
+    progress = await get_progress(redis, msg_id)
+
+    status_message_id = await job_started(bot, redis, task)
+
+    if status_message_id:
+        await _mark(redis, msg_id, progress, status_message_id=str(status_message_id))
+    else:
+        status_message_id = _status_message(progress)
+
+    outcome = progress.get("delivered")
+    generated = outcome is None
+
+    # без резерва при постановке списываем стоимость до отправки картинки,
+    # иначе при нехватке средств генерация доставлялась бы бесплатно
+    if generated and not _reserved(task, progress):
+        # резерв привязан к задаче в БД: если отметка ниже не запишется,
+        # повторная доставка не спишет деньги второй раз
+        if await reserve_job(_job_ref(msg_id, task), task["user_id"], GENERATION_PRICE) is None:
+            await job_finished(bot, task["chat_id"], status_message_id)
+            await bot.send_message(task["chat_id"], "❌ Недостаточно средств.", reply_markup=after_generation_menu())
+            await ack(redis, msg_id, task)
+            return
+
+        await _mark(redis, msg_id, progress, reserved=str(GENERATION_PRICE))
+
+    if generated:
+        outcome = await deliver_result(bot, redis, msg_id, task, progress, status_message_id)
+
+        if outcome is None:
+            await ack(redis, msg_id, task)
+            return
+
+    await job_finished(bot, task["chat_id"], status_message_id)
+    await complete_generation(bot, redis, msg_id, task, progress)
+
+    await ack(redis, msg_id, task)
+    GENERATIONS.labels(task["model"], outcome).inc()
+
+    # время обработки по модели — основа для ETA в статусе очереди
+    if generated and outcome == "ok":
+        await record_service_time(redis, task["model"], time.monotonic() - started)
+
+
+async def abandon_job(bot, redis, msg_id, task):
+
+    # повтор не поможет: если картинка уже у пользователя — доводим списание,
+    # иначе возвращаем деньги и сообщаем об ошибке
+    progress = await get_progress(redis, msg_id)
+
+    await job_finished(bot, task["chat_id"], _status_message(progress))
+
+    if "delivered" in progress:
+        if "settled" not in progress:
+            await settle(task["user_id"], task["model"], _reserved(task, progress), _job_ref(msg_id, task))
+    else:
+        await fail_generation(bot, redis, msg_id, task, progress)
+
+
+async def keep_alive(redis, consumer, msg_id):
+
+    # генерация идёт дольше WORKER_HEARTBEAT_TTL — пока задача выполняется,
+    # worker продолжает отмечаться, иначе ETA считается по меньшему числу worker;
+    # заодно продлеваем владение задачей, чтобы её не переназначили посреди работы
+    while True:
+        await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+        try:
+            await heartbeat(redis, consumer)
+            await touch(redis, consumer, msg_id)
+        except Exception:
+            logging.exception("Heartbeat error")
+
+
+async def generation_worker(bot, redis, consumer, stop_event):
+
+    limiter = upstream()
+
+    while not stop_event.is_set():
+
+        # задачу из очереди берём, только пока апстрим справляется с текущей нагрузкой
+        await limiter.acquire()
+
+        try:
+
+            if stop_event.is_set():
+                continue
+
+            await heartbeat(redis, consumer)
+
+            job = await fetch(redis, consumer)
+
+            if job is None:
+                continue
+
+            msg_id, task, attempts = job
+
+            # задача несколько раз роняла worker — убираем её в dead-letter
+            if attempts > MAX_ATTEMPTS:
+                await abandon_job(bot, redis, msg_id, task)
+                await dead_letter(redis, msg_id, task, attempts, "max attempts exceeded")
+                continue
+
+            ticker = asyncio.create_task(keep_alive(redis, consumer, msg_id))
+
+            try:
+                await process_job(bot, redis, msg_id, task)
+
+            except TRANSIENT_ERRORS:
+                raise
+
+            except Exception:
+                logging.exception(f"Generation {msg_id} failed permanently")
+                await abandon_job(bot, redis, msg_id, task)
+                await ack(redis, msg_id, task)
+
+            finally:
+                ticker.cancel()
+
+        except Exception:
+
+            logging.exception("Worker error")
+
+            # задача остаётся без ack и будет переназначена после таймаута видимости
+            await asyncio.sleep(5)
+
+        finally:
+            await limiter.release()
+
+
+def start_workers(bot, redis, count):
+
+    global _stop_event
+
+    _stop_event = asyncio.Event()
+
+    # count — потолок параллельности процесса; адаптивный лимит
+    # может временно держать часть worker в ожидании
+    configure_limits(count)
+
+    for i in range(count):
+        consumer = f"{socket.gethostname()}-{os.getpid()}-{i}"
+        _tasks.append(asyncio.create_task(
+            generation_worker(bot, redis, consumer, _stop_event)
+        ))
+
+    return _tasks
+
+
+async def stop_workers():
+
+    if _stop_event is None or not _tasks:
+        return
+
+    # новые задачи не берём, текущие даём дописать
+    _stop_event.set()
+    await upstream().close()
+
+    done, pending = await asyncio.wait(_tasks, timeout=WORKER_SHUTDOWN_TIMEOUT)
+
+    # недописанные задачи останутся без ack и будут переназначены
+    for task in pending:
+        task.cancel()
+
+    _tasks.clear()
+
+    shutdown_pipeline()
+
+
+# ================= STANDALONE =================
+
+async def main():
+
+    bot = Bot(
+        token=TOKEN,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+    )
+    redis = Redis.from_url(REDIS_URL)
+
+    await init_session()
+    await init_queue(redis)
+
+    configure_user_cache(redis)
+    listener = asyncio.create_task(listen_invalidations())
+
+    # у отдельного worker свой /metrics на METRICS_PORT
+    metrics_runner = None
+
+    if METRICS_PORT:
+        register_collector(collect_limit_metrics)
+        register_collector(collect_cache_metrics)
+        metrics_runner = await start_metrics_server(METRICS_PORT)
+
+    start_workers(bot, redis, WORKER_CONCURRENCY)
+
+    logging.warning(
+        f"Generation worker started, concurrency={WORKER_CONCURRENCY}"
+    )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    await stop.wait()
+
+    await stop_workers()
+    listener.cancel()
+
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+    await close_session()
+    await close_db()
+    await bot.session.close()
+    await redis.aclose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main())